@@ -1,13 +1,49 @@
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, Response, render_template, request, jsonify, stream_with_context
+import glob
+import json
 import os
 from werkzeug.utils import secure_filename
 import tempfile
-from xml_validator import validate_xml
+import threading
+import uuid
+from collections import OrderedDict
+# xml_validator puts the notebooks' directory, where validation is kept, on the path
+from xml_validator import ValidationSession, validate_stream
+from validation import FramenameIndex
 from svg_generator import graphml_to_svg
 
 app = Flask(__name__)
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
 app.config['UPLOAD_FOLDER'] = tempfile.gettempdir()
+app.config['MAX_VALIDATION_SESSIONS'] = 20  # documents kept in memory for re-validating edits
+app.config['MAX_VALIDATION_ERRORS'] = 100  # uploads stop being validated after this many errors
+app.config['WORK_FILES'] = None  # glob pattern of the files of a multi-file work, eg. 'works/clarissa/*.xml', whose topoi connections can refer to
+app.config['WORK_INDEX'] = os.path.join(tempfile.gettempdir(), 'chronotopic-framenames.json')  # where the work's framenames are kept between runs
+
+# Validation sessions by id, least recently used first
+validation_sessions = OrderedDict()
+validation_lock = threading.Lock()
+
+# The framename index of the work in WORK_FILES, loaded on first use
+work_index = None
+
+def current_work(volume=None):
+    """
+    The framename index of the work in WORK_FILES, brought up to date with its files, and the path of the work's file named volume, if there is one.
+    Returns (None, None) if no work has been set.
+    """
+    global work_index
+    if app.config['WORK_FILES'] is None:
+        return None, None
+    
+    with validation_lock:
+        if work_index is None:
+            work_index = FramenameIndex(path=app.config['WORK_INDEX'])
+        if len(work_index.refresh(glob.glob(app.config['WORK_FILES']))) > 0:
+            work_index.save()
+    
+    files = [file for file in work_index.files if volume and os.path.basename(file) == volume]
+    return work_index, files[0] if len(files) > 0 else None
 
 @app.route('/')
 def index():
@@ -18,10 +54,51 @@ def validate_xml_page():
     if request.method == 'POST':
         xml_content = request.form.get('xml_content', '')
         if xml_content:
-            errors = validate_xml(xml_content)
-            return jsonify({'errors': errors})
+            work, volume = current_work(request.form.get('volume'))
+            session = ValidationSession(xml_content, work=work, file=volume)
+            session_id = uuid.uuid4().hex
+            with validation_lock:
+                validation_sessions[session_id] = session
+                while len(validation_sessions) > app.config['MAX_VALIDATION_SESSIONS']:
+                    validation_sessions.popitem(last=False)
+                errors = session.errors()
+            return jsonify({'errors': errors, 'session': session_id})
     return render_template('validate_xml.html')
 
+@app.route('/validate-xml/update', methods=['POST'])
+def validate_xml_update():
+    """Re-validate the lines of a document that have changed since it was last validated"""
+    data = request.get_json(silent=True) or {}
+    session_id = data.get('session')
+    
+    with validation_lock:
+        session = validation_sessions.get(session_id)
+        if session is None:
+            return jsonify({'error': 'Validation session has expired'}), 404
+        validation_sessions.move_to_end(session_id)
+        
+        try:
+            session.update(int(data['start']), int(data['end']), [str(line) for line in data['lines']])
+        except (KeyError, TypeError, ValueError) as e:
+            return jsonify({'error': str(e)}), 400
+        
+        errors = session.errors()
+    return jsonify({'errors': errors, 'session': session_id})
+
+@app.route('/validate-xml/upload', methods=['POST'])
+def validate_xml_upload():
+    """Validate an XML file sent as the request body, streaming back one line of JSON per error or warning as it's found"""
+    max_errors = request.args.get('max_errors', app.config['MAX_VALIDATION_ERRORS'], type=int)
+    work, volume = current_work(request.args.get('volume'))
+    # Taken before the response starts, so that a body over MAX_CONTENT_LENGTH is turned away with a 413 rather than cutting the stream short
+    stream = request.stream
+    
+    def generate():
+        for item in validate_stream(stream, max_errors=max_errors, work=work, file=volume):
+            yield json.dumps(item) + '\n'
+    
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
 @app.route('/visualize', methods=['GET', 'POST'])
 def visualize_page():
     if request.method == 'POST':
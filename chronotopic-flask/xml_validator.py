@@ -1,178 +1,449 @@
+from collections import Counter
 from lxml import etree
 import io
+import os
+import re
+import sys
 
-def check_xml_is_well_formed(xml_string):
-    """Check if XML is well-formed"""
+# The validation rules are shared with the notebooks, and kept with them. The notebooks' directory goes last on the path, so that the app's own modules (eg. styles) come first.
+NOTEBOOKS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'notebooks')
+if NOTEBOOKS not in sys.path:
+    sys.path.append(NOTEBOOKS)
+
+from validation import RULES, RuleEngine, ListSink, SuggestionIndex, TAGS, WorkNames, finding, problems, trigrams
+
+# Markup that can run over several lines: comments, CDATA sections, processing instructions and tags (whose attribute values may hold a '>')
+MARKUP = re.compile(r'<!--.*?-->|<!\[CDATA\[.*?\]\]>|<\?.*?\?>|<(?:[^>"\']|"[^"]*"|\'[^\']*\')*>', re.DOTALL)
+
+# Elements that deferred rules check, once every framename is known
+deferred_tags = set(r.tag for r in RULES if r.deferred)
+
+# As in validation.sort_findings, findings on the same line are grouped by category, in the order the categories' rules are registered
+category_order = {}
+for r in RULES:
+    category_order.setdefault(r.category, len(category_order))
+
+
+def parse_xml(xml_content):
+    """Parse the XML, returning the tree, or None and the errors to report"""
     try:
-        etree.parse(io.StringIO(xml_string))
-        return True, "XML is well-formed"
+        return etree.parse(io.BytesIO(xml_content.encode('utf-8'))), []
     except etree.XMLSyntaxError as e:
-        return False, str(e)
+        return None, [{
+            'type': 'error',
+            'category': 'syntax',
+            'message': f'XML Syntax Error: {str(e)}'
+        }]
+    except Exception as e:
+        return None, [{
+            'type': 'error',
+            'category': 'parsing',
+            'message': f'Failed to parse XML: {str(e)}'
+        }]
+
 
-def validate_xml(xml_content):
+def validate_xml(xml_content, work=None, file=None):
     """
     Validate Chronotopic Cartographies XML and return list of errors/warnings
+    work: a validation.FramenameIndex of a multi-file work, so that connections can refer to topoi in its files. file is the path of the work's file that the XML is a version of, if any, so that its old framenames are ignored.
     """
-    errors = []
-    
-    # First check if XML is well-formed
-    is_valid, message = check_xml_is_well_formed(xml_content)
-    if not is_valid:
-        errors.append({
-            'type': 'error',
-            'category': 'syntax',
-            'message': f'XML Syntax Error: {message}'
-        })
+    # Parse once: a syntax error here is the same error the well-formedness check reports
+    tree, errors = parse_xml(xml_content)
+    if tree is None:
         return errors
-    
-    # Parse the XML
+
+    # Run every rule in validation.RULES over the document in a single pass
+    sink = ListSink()
+    RuleEngine(sinks=[sink], work=work, file=file).validate(tree.getroot())
+    return sink.findings
+
+
+def validate_stream(stream, max_errors=None, chunk_size=64 * 1024, work=None, file=None):
+    """
+    Validate XML read from a binary stream, eg. an upload, yielding each error or warning as soon as it's found.
+    The XML is fed to a pull parser a chunk at a time, and elements are cleared once they have been checked, so the document is never held in memory in full.
+    Reading stops at max_errors errors, or at a syntax error. The last item yielded is {'summary': {...}}, with the numbers of errors and warnings, whether reading stopped early, and the bytes read.
+    work and file are as for validate_xml.
+    """
+    sink = ListSink()
+    engine = RuleEngine(sinks=[sink], max_errors=max_errors, work=work, file=file)
+    parser = etree.XMLPullParser(events=('start', 'end'))
+    counts = {'error': 0, 'warning': 0}
+    size = 0
+
+    def found():
+        # Hand over whatever the engine has found since last time
+        findings = sink.findings
+        sink.findings = []
+        for f in findings:
+            counts[f['type']] += 1
+        return findings
+
     try:
-        tree = etree.parse(io.StringIO(xml_content))
-        xml_element = tree.getroot()
-    except Exception as e:
-        errors.append({
+        while not engine.stopped:
+            chunk = stream.read(chunk_size)
+            if not chunk:
+                parser.close()
+                break
+            size += len(chunk)
+            parser.feed(chunk)
+
+            for event, el in parser.read_events():
+                if event == 'start':
+                    if el.tag in TAGS:
+                        engine.check(el.tag, el.attrib, el.sourceline)
+                        if engine.stopped:
+                            break
+                else:
+                    el.clear(keep_tail=True)
+                    parent = el.getparent()
+                    while parent is not None and el.getprevious() is not None:
+                        del parent[0]
+
+            yield from found()
+    except etree.XMLSyntaxError as e:
+        yield from found()
+        counts['error'] += 1
+        engine.stopped = True
+        yield {
             'type': 'error',
-            'category': 'parsing',
-            'message': f'Failed to parse XML: {str(e)}'
-        })
+            'category': 'syntax',
+            'line': e.lineno,
+            'message': f'XML Syntax Error: {str(e)}'
+        }
+
+    engine.finish()
+    yield from found()
+
+    yield {'summary': {'errors': counts['error'], 'warnings': counts['warning'], 'stopped': engine.stopped, 'bytes': size}}
+
+
+class Lookups:
+    """
+    Stands in for the framenames passed to deferred rules, noting the names they look up and the words they ask for suggestions for.
+    A session uses them to tell which elements' findings an edit to the framenames can have changed.
+    """
+
+    def __init__(self, framenames):
+        self.framenames = framenames
+        self.names = set()
+        self.words = set()
+
+    def __contains__(self, name):
+        self.names.add(name)
+        return name in self.framenames
+
+    def suggest(self, word, *args, **kwargs):
+        self.words.add(word)
+        return self.framenames.suggest(word, *args, **kwargs)
+
+
+class ValidationSession:
+    """
+    Keeps the results of validating a document, so that when a few of its lines are edited only those lines need to be checked again.
+    For every line the session keeps the problems with the elements whose start tags end on it, alongside a count of every framename in the document.
+    An edit is checked on its own if the old and new lines are both complete runs of XML, so that the rest of the document can't have been affected. Anything else is validated in full.
+    The findings of the deferred rules are kept too, and only checked again for references to framenames that the edit added or removed.
+    """
+
+    # The lines of the document, without their line breaks
+    lines = None
+
+    # For each line, (tag, problems, attributes, framename) for each CC element on it, where problems are the (rule, text) findings of its non-deferred rules.
+    # Attributes are only kept for elements with deferred rules, and framename is only set for topoi.
+    elements = None
+
+    # For each line, whether it starts part way through a tag, comment, CDATA section or processing instruction
+    in_markup = None
+
+    # Every topos framename, counting the topoi with each, indexed for suggestions
+    node_names = None
+
+    # For each element with deferred rules, by the id of its entry in elements: (entry, the list of entries on its line in elements, findings of the deferred rules, names they looked up, words they made suggestions for)
+    references = None
+
+    # The ids of the elements whose deferred rules looked up each name, or made suggestions for it
+    looked_up = None
+
+    # The words that deferred rules made suggestions for, indexed by trigram
+    suggested_for = None
+
+    # For each of those words, the trigrams whose posting lists in node_names its suggestions were made from (see SuggestionIndex.rarest), and the length of the longest of those lists
+    reads = None
+
+    # For each line with any findings, by its index in lines, the line's (rule, text) findings in the order they're reported
+    line_errors = None
+
+    # The errors as errors() last returned them, or None if the document has changed since
+    cached_errors = None
+
+    # The FramenameIndex of the multi-file work the document belongs to, and the path of its file in the work, as for validate_xml
+    work = None
+    file = None
+
+    # The hash of each of the work's files when the references were last checked, as they can also refer to topoi in those
+    work_hashes = None
+
+    # The lines holding the end of the root element's start tag and the start of its end tag. Only lines between them can be checked on their own.
+    root_start = 0
+    root_end = 0
+
+    # Errors from a document that couldn't be parsed, or None
+    syntax_errors = None
+
+    def __init__(self, xml_content, work=None, file=None):
+        self.work = work
+        self.file = file
+        self.validate(xml_content)
+
+    def validate(self, xml_content):
+        """Validate the whole document. Its errors are then returned by errors()."""
+        self.lines = xml_content.split('\n')
+        self.elements = [[] for line in self.lines]
+        self.in_markup = self._find_markup(xml_content, len(self.lines))
+        self.node_names = SuggestionIndex()
+        self.references = {}
+        self.looked_up = {}
+        self.suggested_for = SuggestionIndex()
+        self.reads = {}
+        self.line_errors = {}
+        self.cached_errors = None
+        self.work_hashes = self._work_hashes()
+
+        tree, self.syntax_errors = parse_xml(xml_content)
+        if tree is None:
+            return
+        self.syntax_errors = None
+
+        root = tree.getroot()
+        self._check_references(self._add_elements(root, 0))
+        for index in range(len(self.lines)):
+            self._collect(index)
+        self.root_start = root.sourceline
+        end_tag = xml_content.rfind('</' + root.tag)
+        self.root_end = xml_content.count('\n', 0, end_tag) + 1 if end_tag != -1 else root.sourceline
+
+    def update(self, start, end, new_lines):
+        """
+        Replace lines start to end (counting from 1, inclusive) with new_lines, and check them. The edited document's errors are then returned by errors().
+        To insert lines without replacing any, set end to start - 1.
+        """
+        if not (1 <= start <= len(self.lines) + 1 and start - 1 <= end <= len(self.lines)):
+            raise ValueError(f'Lines {start} to {end} are not in the document')
+
+        new_lines = [part for line in new_lines for part in line.split('\n')]
+
+        fragment = self._parse_edit(start, end, new_lines)
+        if fragment is None:
+            self.validate('\n'.join(self.lines[:start - 1] + new_lines + self.lines[end:]))
+            return
+
+        # The old elements' framenames and references no longer count
+        edited = Counter()
+        for elements in self.elements[start - 1:end]:
+            for entry in elements:
+                tag, found, attrib, framename = entry
+                if framename is not None:
+                    self.node_names.remove(framename)
+                    edited[framename] -= 1
+                if attrib is not None:
+                    self._forget_references(entry)
+
+        shift = len(new_lines) - (end - start + 1)
+        self.lines[start - 1:end] = new_lines
+        self.elements[start - 1:end] = [[] for line in new_lines]
+        self.in_markup[start - 1:end] = self._find_markup('\n'.join(new_lines), len(new_lines))
+        self.line_errors = {index if index < start - 1 else index + shift: found for index, found in self.line_errors.items() if not start - 1 <= index < end}
+        # The fragment starts with a line of its own, opening any elements that the edited lines close
+        added = self._add_elements(fragment, start - 2, first_line=2)
+        self.root_end += shift
+        self.cached_errors = None
+
+        # Only references to framenames that are now in the document and weren't before, or the other way round, can have different findings
+        edited.update(entry[3] for entry, elements in added if entry[3] is not None)
+        stale = set()
+        grown = Counter()
+        for name, change in edited.items():
+            count = self.node_names.counts.get(name, 0)
+            if (count == 0) != (count - change == 0):
+                stale.update(self.looked_up.get(name, ()))
+                for gram in trigrams(name):
+                    grown[gram] += 1 if count > 0 else -1
+
+        # Suggestions for a word can only change if one of the posting lists they were made from has changed, or another of the word's lists has become short enough to be read instead
+        for gram, change in grown.items():
+            size = len(self.node_names.postings.get(gram, ()))
+            for word in self.suggested_for.postings.get(gram, ()):
+                grams, longest = self.reads[word]
+                if gram in grams or size <= longest or (size == 0) != (size - change == 0):
+                    stale.update(self.looked_up[word])
+
+        stale = [self.references[key][:2] for key in stale]
+        self._check_references(stale + added)
+        for index in range(start - 1, start - 1 + len(new_lines)):
+            self._collect(index)
+        if len(stale) > 0:
+            # The lists of entries move with their lines, so they can be found by identity
+            lines = set(id(elements) for entry, elements in stale)
+            for index in [index for index, elements in enumerate(self.elements) if id(elements) in lines]:
+                self._collect(index)
+
+    def errors(self):
+        """The errors in the document, in the same order as validate_xml returns them"""
+        if self.syntax_errors is not None:
+            return self.syntax_errors
+
+        # If another file of the work has changed, eg. been uploaded again, every reference is checked again
+        if self.work_hashes != self._work_hashes():
+            self.work_hashes = self._work_hashes()
+            self._check_references([reference[:2] for reference in self.references.values()])
+            for index in range(len(self.lines)):
+                self._collect(index)
+            self.cached_errors = None
+
+        if self.cached_errors is not None:
+            return self.cached_errors
+
+        errors = []
+        for index in sorted(self.line_errors):
+            errors += [finding(r, index + 1, text) for r, text in self.line_errors[index]]
+        self.cached_errors = errors
         return errors
-    
-    # Valid chronotope types
-    chronotopes = [
-        'anti-idyll', 'castle', 'distortion', 'encounter', 
-        'idyll', 'metanarrative', 'parlour', 'public square', 
-        'road', 'threshold', 'provincial town', 'wilderness'
-    ]
-    
-    # Valid connection relations
-    connections = [
-        'direct', 'indirect', 'interrupt', 'jump', 
-        'charshift', 'projection', 'metatextual', 
-        'paratextual', 'intratextual', 'metaphor'
-    ]
-    
-    # Track all node names for reference checking
-    node_names = []
-    
-    # Check topos elements
-    for topos in xml_element.iter('topos'):
-        line = topos.sourceline
-        
-        # Check type attribute
-        if 'type' not in topos.attrib:
-            errors.append({
-                'type': 'error',
-                'category': 'topos',
-                'line': line,
-                'message': f'Line {line}: <topos> missing required "type" attribute'
-            })
-        elif topos.attrib['type'] not in chronotopes:
-            errors.append({
-                'type': 'warning',
-                'category': 'topos',
-                'line': line,
-                'message': f'Line {line}: Unknown chronotope type "{topos.attrib["type"]}". Valid types: {", ".join(chronotopes)}'
-            })
-        
-        # Check framename attribute
-        if 'framename' not in topos.attrib:
-            errors.append({
-                'type': 'error',
-                'category': 'topos',
-                'line': line,
-                'message': f'Line {line}: <topos> missing required "framename" attribute'
-            })
+
+    def _work_hashes(self):
+        return None if self.work is None else {file: entry['hash'] for file, entry in self.work.files.items()}
+
+    def _collect(self, index):
+        """Gather the findings of the elements on a line, once they've been checked"""
+        found = []
+        for entry in self.elements[index]:
+            tag, checked, attrib, framename = entry
+            found += checked
+            if attrib is not None:
+                found += self.references[id(entry)][2]
+
+        if len(found) > 0:
+            found.sort(key=lambda problem: category_order[problem[0].category])
+            self.line_errors[index] = found
         else:
-            node_names.append(topos.attrib['framename'])
-    
-    # Check connection elements
-    for connection in xml_element.iter('connection'):
-        line = connection.sourceline
-        
-        # Check source attribute
-        if 'source' not in connection.attrib:
-            errors.append({
-                'type': 'error',
-                'category': 'connection',
-                'line': line,
-                'message': f'Line {line}: <connection> missing required "source" attribute'
-            })
-        
-        # Check target attribute
-        if 'target' not in connection.attrib:
-            errors.append({
-                'type': 'error',
-                'category': 'connection',
-                'line': line,
-                'message': f'Line {line}: <connection> missing required "target" attribute'
-            })
-        
-        # Check relation attribute
-        if 'relation' not in connection.attrib:
-            errors.append({
-                'type': 'error',
-                'category': 'connection',
-                'line': line,
-                'message': f'Line {line}: <connection> missing required "relation" attribute'
-            })
-        elif connection.attrib['relation'] not in connections:
-            errors.append({
-                'type': 'warning',
-                'category': 'connection',
-                'line': line,
-                'message': f'Line {line}: Unknown relation type "{connection.attrib["relation"]}". Valid types: {", ".join(connections)}'
-            })
-    
-    # Check that connection sources and targets exist
-    for connection in xml_element.iter('connection'):
-        line = connection.sourceline
-        
-        if 'source' in connection.attrib and connection.attrib['source'] not in node_names:
-            errors.append({
-                'type': 'error',
-                'category': 'reference',
-                'line': line,
-                'message': f'Line {line}: Connection source "{connection.attrib["source"]}" does not match any topos framename'
-            })
-        
-        if 'target' in connection.attrib and connection.attrib['target'] not in node_names:
-            errors.append({
-                'type': 'error',
-                'category': 'reference',
-                'line': line,
-                'message': f'Line {line}: Connection target "{connection.attrib["target"]}" does not match any topos framename'
-            })
-    
-    # Check toporef elements
-    for toporef in xml_element.iter('toporef'):
-        line = toporef.sourceline
-        
-        # Check role attribute
-        if 'role' not in toporef.attrib:
-            errors.append({
-                'type': 'error',
-                'category': 'toporef',
-                'line': line,
-                'message': f'Line {line}: <toporef> missing required "role" attribute'
-            })
-        
-        # Check relation attribute (optional for toporef unless in sequence)
-        if 'sequence' not in toporef.attrib and 'relation' not in toporef.attrib:
-            errors.append({
-                'type': 'error',
-                'category': 'toporef',
-                'line': line,
-                'message': f'Line {line}: <toporef> missing required "relation" attribute'
-            })
-        elif 'relation' in toporef.attrib and toporef.attrib['relation'] not in connections:
-            errors.append({
-                'type': 'warning',
-                'category': 'toporef',
-                'line': line,
-                'message': f'Line {line}: Unknown relation type "{toporef.attrib["relation"]}". Valid types: {", ".join(connections)}'
-            })
-    
-    # Sort errors by line number
-    errors.sort(key=lambda x: x.get('line', 0))
-    
-    return errors
\ No newline at end of file
+            self.line_errors.pop(index, None)
+
+    def _check_references(self, entries):
+        """Run the deferred rules for elements, given as (entry, entries on its line), noting the framenames each depends on"""
+        framenames = self.node_names if self.work is None else WorkNames(self.node_names, self.work, self.file)
+        for entry, elements in entries:
+            tag, found, attrib, framename = entry
+            if attrib is None:
+                continue
+            self._forget_references(entry)
+
+            lookups = Lookups(framenames)
+            self.references[id(entry)] = (entry, elements, problems(tag, attrib, framenames=lookups), lookups.names, lookups.words)
+            for name in lookups.names | lookups.words:
+                self.looked_up.setdefault(name, set()).add(id(entry))
+            for word in lookups.words:
+                self.suggested_for.add(word)
+                grams = self.node_names.rarest(word)
+                self.reads[word] = (set(grams), len(self.node_names.postings[grams[-1]]) if len(grams) > 0 else 0)
+
+    def _forget_references(self, entry):
+        """Drop the findings of an element's deferred rules, eg. when it's been edited"""
+        reference = self.references.pop(id(entry), None)
+        if reference is None:
+            return
+        entry, elements, found, names, words = reference
+        for name in names | words:
+            self.looked_up[name].discard(id(entry))
+            if len(self.looked_up[name]) == 0:
+                del self.looked_up[name]
+        for word in words:
+            self.suggested_for.remove(word)
+            if word not in self.suggested_for:
+                del self.reads[word]
+
+    def _add_elements(self, root, line_offset, first_line=1):
+        """Check the CC elements in a tree, and record them under their lines. Elements before first_line are skipped. Returns (entry, entries on its line) for each."""
+        added = []
+        for el in root.iter(*TAGS):
+            if el.sourceline < first_line:
+                continue
+            attrib = el.attrib
+            framename = attrib.get('framename') if el.tag == 'topos' else None
+            if framename is not None:
+                self.node_names.add(framename)
+            deferred = dict(attrib) if el.tag in deferred_tags else None
+
+            entry = (el.tag, problems(el.tag, attrib), deferred, framename)
+            elements = self.elements[el.sourceline - 1 + line_offset]
+            elements.append(entry)
+            added.append((entry, elements))
+        return added
+
+    def _parse_edit(self, start, end, new_lines):
+        """
+        Parse new_lines on their own, if they can replace lines start to end without checking the rest of the document.
+        Returns the parsed lines wrapped in a <fragment> element, or None if the whole document needs validating.
+        """
+        if self.syntax_errors is not None:
+            return None
+
+        # The edit has to be inside the root element, and begin and end between pieces of markup rather than part way through one
+        if not (self.root_start < start and start - 1 <= end < self.root_end):
+            return None
+        if self.in_markup[start - 1] or self.in_markup[end]:
+            return None
+
+        # If the new lines open and close the same elements as the old lines did, eg. when only the attributes of a start tag have changed, then the rest of the document is nested just as before
+        old_text = '\n'.join(self.lines[start - 1:end])
+        new_text = '\n'.join(new_lines)
+        tags = self._unmatched_tags(new_text)
+        if tags is None or tags != self._unmatched_tags(old_text):
+            return None
+        closes, opens = tags
+
+        # Parse the new lines on their own, completing any elements they leave open or closed
+        try:
+            return etree.fromstring(
+                '<fragment>' + ''.join('<' + name + '>' for name in reversed(closes)) + '\n'
+                + new_text
+                + ''.join('</' + name + '>' for name in reversed(opens)) + '</fragment>'
+            )
+        except etree.XMLSyntaxError:
+            return None
+
+    @staticmethod
+    def _unmatched_tags(text):
+        """
+        Returns the names of the elements that a run of XML closes without opening, and opens without closing, in the order they appear.
+        Returns None if its tags don't nest.
+        """
+        closes = []
+        opens = []
+        for match in MARKUP.finditer(text):
+            tag = match.group()
+            if tag[1] in '!?' or tag.endswith('/>'):
+                continue
+            if tag[1] == '/':
+                name = tag[2:-1].strip()
+                if len(opens) == 0:
+                    closes.append(name)
+                elif opens.pop() != name:
+                    return None
+            else:
+                opens.append(re.split(r'[\s/>]', tag[1:], 1)[0])
+        return closes, opens
+
+    @staticmethod
+    def _find_markup(text, line_count):
+        """For each line of text, whether it starts part way through a piece of markup"""
+        in_markup = [False] * line_count
+        line = 0
+        position = 0
+        for match in MARKUP.finditer(text):
+            line += text.count('\n', position, match.start())
+            position = match.end()
+            lines = text.count('\n', match.start(), position)
+            for index in range(line + 1, line + lines + 1):
+                in_markup[index] = True
+            line += lines
+        return in_markup
@@ -0,0 +1,54 @@
+# Python Core
+import hashlib
+import json
+import os
+
+
+def fingerprint(inputs):
+    """Returns a hash of a dict of inputs, eg. a source file hash, generator and layout settings"""
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+class ArtifactStore:
+    """
+    Records the inputs that every output file in a directory was built from, so that rebuilds can skip outputs whose inputs haven't changed.
+    Each output's record is kept in its own small JSON file, so that several processes can record outputs in the same directory at once.
+    """
+
+    directory = None
+
+    def __init__(self, directory, store_dir='.artifacts'):
+        self.directory = os.path.join(directory, store_dir)
+
+    def _record_file(self, key):
+        """Keys are free text (eg. file names), so records are stored under a hash of the key"""
+        return os.path.join(self.directory, hashlib.sha256(key.encode('utf-8')).hexdigest() + '.json')
+
+    def get(self, key):
+        """Returns the record for a key, or None if the output has never been recorded"""
+        try:
+            with open(self._record_file(key)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def is_current(self, key, inputs):
+        """Whether the output recorded under key was built from exactly these inputs, and is still on disk"""
+        record = self.get(key)
+        return record is not None and record['fingerprint'] == fingerprint(inputs) and os.path.exists(record['output'])
+
+    def record(self, key, inputs, output):
+        """Record that output has just been built from inputs"""
+        record = {
+            'key': key,
+            'output': output,
+            'fingerprint': fingerprint(inputs),
+            'inputs': inputs
+        }
+
+        # Write to a temporary file first, so that a record is never half-written
+        os.makedirs(self.directory, exist_ok=True)
+        record_file = self._record_file(key)
+        with open(record_file + '.' + str(os.getpid()) + '.tmp', 'w') as f:
+            f.write(json.dumps(record, indent=4))
+        os.replace(record_file + '.' + str(os.getpid()) + '.tmp', record_file)
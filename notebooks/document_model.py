@@ -0,0 +1,459 @@
+# Python Core
+from lxml import etree
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import io
+import os
+import pickle
+import re
+
+# Comments and processing instructions are followed as well as elements, as the text after them is still part of the document's text
+EVENTS = ('start', 'end', 'comment', 'pi')
+
+# Bump this whenever the tables extracted by CCDocument change, so that documents cached by an older version are parsed again
+MODEL_VERSION = 1
+
+# The attributes of a CCDocument that make up its tables, and are stored in the cache
+TABLES = ('topoi', 'connections', 'toporefs', 'sequences', 'element_count')
+
+# Start tags that documents are split at by CCDocument.from_chapters
+CHAPTER_START = re.compile(rb'<chapter[\s/>]')
+
+
+class EncodedReader:
+    """Reads a text stream as UTF-8 bytes, a chunk at a time, for parsers that only take bytes"""
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def read(self, size=-1):
+        return self.stream.read(size).encode('utf-8')
+
+
+class CCDocument:
+    """
+    The topoi, connections and toporefs of a Chrono-carto encoded XML file, extracted in a single pass over the document.
+    Every graph generator can be built from the same CCDocument, so a full set of graphs only costs one parse.
+    """
+
+    # Topoi, connections and toporefs are lists of dicts, in the order in which their start tags appear in the document.
+    # Each dict keeps a copy of the element's attributes under 'attrib', alongside the values worked out while parsing.
+    topoi = None
+    connections = None
+    toporefs = None
+
+    # Sequence name -> indices (into toporefs) of the toporefs in that sequence, in document order
+    sequences = None
+
+    # Number of elements seen, used to give every element a position in document order
+    element_count = 0
+
+    # SHA-256 of the file the document was loaded from by load_document, or None if it wasn't loaded from a file
+    source_hash = None
+
+    def __init__(self, file, xml_dir='', streaming=False):
+        """
+        Parses the XML and extracts the tables. As with the graph generators, a path relative to xml_dir, a path, or a file-like object can be passed.
+        With streaming=True the file is read with iterparse and elements are cleared away once they have been recorded, so the full tree is never held in memory.
+        """
+        if streaming:
+            if isinstance(file, str) and os.path.exists(xml_dir + file):
+                file = xml_dir + file
+            if isinstance(file, io.TextIOBase):
+                # iterparse only reads bytes, so text, eg. from a StringIO, is encoded as it's read - and the XML declaration's encoding no longer applies
+                self._build(etree.iterparse(EncodedReader(file), events=EVENTS, encoding='utf-8'), streaming=True)
+            else:
+                self._build(etree.iterparse(file, events=EVENTS), streaming=True)
+        else:
+            try:
+                tree = etree.parse(xml_dir + file)
+            except:
+                tree = etree.parse(file)
+            self._build(etree.iterwalk(tree.getroot(), events=EVENTS))
+
+    @classmethod
+    def from_element(cls, element):
+        """Extracts the tables from an element that has already been parsed, eg. by a validator that also needs the tree"""
+        document = cls.__new__(cls)
+        document._build(etree.iterwalk(element, events=EVENTS))
+        return document
+
+    @classmethod
+    def from_tables(cls, tables):
+        """Recreates a document from the dict returned by its tables method"""
+        document = cls.__new__(cls)
+        for name in TABLES:
+            setattr(document, name, tables[name])
+        return document
+
+    @classmethod
+    def from_chapters(cls, file, xml_dir='', processes=None):
+        """
+        Parses a long document in parallel: the file is split into chapters, the tables of each chapter are extracted in a separate process, and then merged.
+        The merged tables are the same as a single pass would give, so timeframes, time indices and connections that cross chapters all come out as before.
+        Chapters must be children of the root element. If the document can't be split that way, it's parsed in a single pass instead.
+        """
+        if isinstance(file, str):
+            if os.path.exists(xml_dir + file):
+                file = xml_dir + file
+            with open(file, 'rb') as f:
+                data = f.read()
+        else:
+            data = file.read()
+            if isinstance(data, str):
+                data = data.encode('utf-8')
+
+        fragments, line_offsets = split_chapters(data)
+        if len(fragments) < 3:
+            return cls(io.BytesIO(data))
+
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            parts = list(pool.map(_chapter_tables, fragments, line_offsets))
+
+        if None in parts:
+            # A fragment wasn't well formed, eg. because a chapter start tag was inside a topos, or inside a comment
+            return cls(io.BytesIO(data))
+
+        return cls.from_tables(merge_tables(parts))
+
+    def tables(self):
+        """Returns the document's tables as a dict of plain lists and dicts, eg. for storing in the cache"""
+        return {name: getattr(self, name) for name in TABLES}
+
+    def _build(self, events, streaming=False):
+        """Fill the tables from a stream of (event, element) pairs"""
+        self.topoi = []
+        self.connections = []
+        self.toporefs = []
+        self.sequences = {}
+        self.element_count = 0
+
+        # Indices of the topoi and toporefs that are currently open, outermost first
+        self._open_topoi = []
+        self._open_toporefs = []
+
+        # A frame for every open element: its running text measure (see measure_text), the length of its own text (None until that has been read), and the element.
+        # An element's text is complete once its first child starts, or once it ends, and an element's tail once the parser has moved on to the next event.
+        frames = []
+        ended = None
+
+        for event, el in events:
+            if ended is not None and len(frames) > 0:
+                self._add_text(frames[-1], ended.tail)
+            ended = None
+
+            if event != 'end' and len(frames) > 0 and frames[-1][4] is None:
+                frames[-1][4] = self._add_text(frames[-1], frames[-1][5].text)
+
+            if event == 'start':
+                frames.append([0, 0, 0, False, None, el])
+                self._start(el)
+
+            elif event != 'end':
+                # Comments and processing instructions aren't part of the text, but what follows them is
+                ended = el
+
+            else:
+                frame = frames.pop()
+                if frame[4] is None:
+                    frame[4] = self._add_text(frame, el.text)
+                self._end(el, frame)
+                if len(frames) > 0:
+                    self._add_text(frames[-1], frame)
+                ended = el
+
+                # Everything this element holds has now been counted, so in streaming mode it can be cleared away along with its earlier siblings
+                if streaming:
+                    el.clear(keep_tail=True)
+                    parent = el.getparent()
+                    while parent is not None and el.getprevious() is not None:
+                        del parent[0]
+
+    def _add_text(self, frame, text):
+        """
+        Add a run of text, or the measure of a child element, to an element's running measure, and return the length added.
+        Text outside any topos is never needed, so it isn't measured.
+        """
+        if len(self._open_topoi) == 0 or text is None:
+            return 0
+
+        if isinstance(text, str):
+            text = measure_text(text)
+
+        length, lead, trail, content = text[:4]
+        if not frame[3]:
+            frame[1] += lead
+        if content:
+            frame[2] = trail
+        else:
+            frame[2] += trail
+        frame[0] += length
+        frame[3] = frame[3] or content
+        return length
+
+    def _start(self, el):
+        """Record an element as its start tag is reached"""
+        position = self.element_count
+        self.element_count += 1
+
+        if el.tag == 'topos':
+            self._open_topoi.append(len(self.topoi))
+            self.topoi.append({
+                'attrib': dict(el.attrib),
+                'position': position,
+                'line': el.sourceline,
+                # The number of connections that precede this topos, ie. its index in the text's timeline
+                'time_index': len(self.connections)
+            })
+
+        elif el.tag == 'connection':
+            parent = el.getparent()
+            self.connections.append({
+                'attrib': dict(el.attrib),
+                'position': position,
+                'line': el.sourceline,
+                'parent': self._open_topoi[-1] if parent is not None and parent.tag == 'topos' else None
+            })
+
+        elif el.tag == 'toporef':
+            # The containing node is the parent topos, or the topos containing the parent connection
+            parent = el.getparent()
+            containing_node = None
+            if parent is not None and parent.tag == 'topos':
+                containing_node = parent.get('framename')
+            elif parent is not None and parent.tag == 'connection':
+                containing_topos = parent.getparent()
+                if containing_topos is not None:
+                    containing_node = containing_topos.get('framename')
+
+            index = len(self.toporefs)
+            self._open_toporefs.append(index)
+            self.toporefs.append({
+                'attrib': dict(el.attrib),
+                'position': position,
+                'line': el.sourceline,
+                'parent': containing_node,
+                'topoi': list(self._open_topoi)
+            })
+
+            if 'sequence' in el.attrib:
+                self.sequences.setdefault(el.attrib['sequence'], []).append(index)
+
+    def _end(self, el, frame):
+        """Record the text content of an element once all of it has been reached"""
+        if el.tag == 'topos':
+            topos = self.topoi[self._open_topoi.pop()]
+            length, lead, trail, content, text_length = frame[:5]
+            topos['length'] = length - lead - trail if content else 0
+            topos['full_length'] = length
+            topos['text_length'] = text_length
+
+        elif el.tag == 'toporef':
+            self.toporefs[self._open_toporefs.pop()]['text'] = el.text
+
+
+def measure_text(text):
+    """
+    Returns the length of a run of text, the number of whitespace characters at its start and end, and whether it has anything other than whitespace.
+    Measures of consecutive runs can be added together, so the stripped length of an element's text can be worked out without joining it into one string.
+    """
+    length = len(text)
+    lead = 0
+    while lead < length and text[lead].isspace():
+        lead += 1
+    if lead == length:
+        return (length, length, length, False)
+
+    trail = 0
+    while text[length - 1 - trail].isspace():
+        trail += 1
+    return (length, lead, trail, True)
+
+
+def split_chapters(data):
+    """
+    Splits the bytes of a document into fragments that each hold one chapter, plus one for anything before the first chapter.
+    Each fragment is a small document of its own, with the original prolog and root element, and anything between chapters stays with the chapter before it.
+    Returns the fragments, and the number of lines to add to line numbers within each fragment to get line numbers in the whole document.
+    """
+    # Skip the XML declaration, comments, processing instructions and doctype to find the root element's start tag
+    position = 0
+    while True:
+        position = data.find(b'<', position)
+        if position == -1:
+            return [data], [0]
+        if data.startswith(b'<?', position):
+            position = data.index(b'?>', position) + 2
+        elif data.startswith(b'<!--', position):
+            position = data.index(b'-->', position) + 3
+        elif data.startswith(b'<!', position):
+            end = data.index(b'>', position)
+            if b'[' in data[position:end]:
+                end = data.index(b'>', data.index(b']', position))
+            position = end + 1
+        else:
+            break
+
+    root_start = re.compile(rb'<[^\s/>]+(?:\s+[^\s=]+\s*=\s*(?:"[^"]*"|\'[^\']*\'))*\s*>').match(data, position)
+    if root_start is None:
+        # An empty root element, or something that isn't XML at all
+        return [data], [0]
+
+    content_start = root_start.end()
+    content_end = data.rindex(b'</')
+    head = data[:content_start]
+    tail = data[content_end:]
+    head_lines = head.count(b'\n')
+
+    boundaries = [content_start] + [match.start() for match in CHAPTER_START.finditer(data, content_start, content_end)] + [content_end]
+
+    fragments = []
+    line_offsets = []
+    lines = head_lines
+    for start, end in zip(boundaries, boundaries[1:]):
+        fragments.append(head + data[start:end] + tail)
+        line_offsets.append(lines - head_lines)
+        lines += data.count(b'\n', start, end)
+
+    return fragments, line_offsets
+
+
+def _chapter_tables(fragment, line_offset):
+    """Extracts the tables of one fragment from split_chapters, with line numbers in the whole document. Returns None if the fragment isn't well formed."""
+    try:
+        document = CCDocument(io.BytesIO(fragment))
+    except etree.XMLSyntaxError:
+        return None
+    for table in (document.topoi, document.connections, document.toporefs):
+        for record in table:
+            record['line'] += line_offset
+    return document.tables()
+
+
+def merge_tables(parts):
+    """
+    Merges the tables of consecutive fragments of a document into the tables of the whole.
+    Every fragment has its own copy of the root element, which is only counted once. Indices into the other tables are shifted by the number of records in the fragments before.
+    """
+    merged = {
+        'topoi': [],
+        'connections': [],
+        'toporefs': [],
+        'sequences': {},
+        'element_count': 1
+    }
+
+    for tables in parts:
+        positions = merged['element_count'] - 1
+        topoi = len(merged['topoi'])
+        connections = len(merged['connections'])
+        toporefs = len(merged['toporefs'])
+
+        for topos in tables['topoi']:
+            topos['position'] += positions
+            topos['time_index'] += connections
+            merged['topoi'].append(topos)
+
+        for connection in tables['connections']:
+            connection['position'] += positions
+            if connection['parent'] is not None:
+                connection['parent'] += topoi
+            merged['connections'].append(connection)
+
+        for toporef in tables['toporefs']:
+            toporef['position'] += positions
+            toporef['topoi'] = [index + topoi for index in toporef['topoi']]
+            merged['toporefs'].append(toporef)
+
+        for sequence, indices in tables['sequences'].items():
+            merged['sequences'].setdefault(sequence, []).extend(index + toporefs for index in indices)
+
+        merged['element_count'] += tables['element_count'] - 1
+
+    return merged
+
+
+def file_hash(path):
+    """Returns the SHA-256 hex digest of a file's contents, read in chunks so large files needn't be held in memory"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def load_document(file, xml_dir='', cache_dir='files/cache/', streaming=False, parallel=False, source_hash=None):
+    """
+    Returns the CCDocument for a file, loading its tables from cache_dir if the same contents have been parsed before by the same MODEL_VERSION.
+    Otherwise the file is parsed and its tables are pickled into the cache for next time. File-like objects, or a cache_dir of None, skip the cache.
+    Documents loaded from a path have their source_hash set, so that outputs built from them can be recorded in an ArtifactStore.
+    parallel: parse the document's chapters in separate processes (see CCDocument.from_chapters) - takes precedence over streaming
+    source_hash: the file's hash, if it's already known (eg. from a FramenameIndex), so the file needn't be read to hash it
+    """
+    if isinstance(file, str) and os.path.exists(xml_dir + file):
+        file = xml_dir + file
+
+    def parse(file):
+        if parallel:
+            return CCDocument.from_chapters(file)
+        return CCDocument(file, streaming=streaming)
+
+    if not isinstance(file, str):
+        return parse(file)
+
+    if source_hash is None:
+        source_hash = file_hash(file)
+
+    if cache_dir is None:
+        document = parse(file)
+        document.source_hash = source_hash
+        return document
+
+    cache_file = os.path.join(cache_dir, source_hash + '-' + str(MODEL_VERSION) + '.pickle')
+
+    try:
+        with open(cache_file, 'rb') as f:
+            document = CCDocument.from_tables(pickle.load(f))
+        document.source_hash = source_hash
+        return document
+    except (OSError, pickle.UnpicklingError, EOFError, KeyError):
+        pass
+
+    document = parse(file)
+    document.source_hash = source_hash
+
+    # Write to a temporary file first, so that an interrupted run never leaves a half-written cache entry. Failing to write the cache shouldn't stop the graphs being generated.
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(cache_file + '.tmp', 'wb') as f:
+            pickle.dump(document.tables(), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(cache_file + '.tmp', cache_file)
+    except OSError:
+        pass
+
+    return document
+
+
+def load_work(files, xml_dir='', cache_dir='files/cache/', work=None):
+    """
+    Returns a single CCDocument for a work coded as several files, eg. one per volume, in the order given, so that connections between topoi in different volumes are kept.
+    Each volume is loaded with load_document, so volumes that haven't changed come from the cache rather than being parsed again. Line numbers are those in each volume's own file.
+    The document's source_hash is a hash of the volumes' hashes, so that its outputs are rebuilt whenever any volume changes.
+    work: a FramenameIndex of the volumes. Volumes that haven't changed since they were indexed aren't read again to hash them.
+    """
+    parts = []
+    hashes = []
+    for file in files:
+        if os.path.exists(xml_dir + file):
+            file = xml_dir + file
+        source_hash = None
+        if work is not None:
+            work.add(file)
+            source_hash = work.hash(file)
+        document = load_document(file, cache_dir=cache_dir, source_hash=source_hash)
+        parts.append(document.tables())
+        hashes.append(document.source_hash)
+
+    document = CCDocument.from_tables(merge_tables(parts))
+    document.source_hash = hashlib.sha256('\n'.join(hashes).encode('utf-8')).hexdigest()
+    return document
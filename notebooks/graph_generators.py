@@ -1,22 +1,37 @@
 # Python Core
 from lxml import etree
 import networkx as nx
-import pprint
+import numpy as np
+import bisect
+import glob
+import math
+import os
 import json
+import time
+import traceback
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from io import StringIO
-
-# 3rd Party
-from bs4 import BeautifulSoup, element
+from xml.sax.saxutils import quoteattr
 
 # This library
+from artifact_store import ArtifactStore, fingerprint
+from layouts import barnes_hut_layout, pack, rescale, stress_layout, timeline_layout, warm_layout
+from document_model import CCDocument, load_document, load_work, file_hash, split_chapters, MODEL_VERSION
 from svg_generators import GraphToSvg
 from styles import colour_style, print_style
+from validation import FramenameIndex, RuleEngine, PprintSink, TextSink, ListSink, TAGS
 
 
 class CCXMLValidator:
     """Checks a Chrono-carto encoded XML file for errors"""
     
     xml_element = None
+    document = None
+    
+    # The path of the file, and the FramenameIndex of the multi-file work it belongs to, if any
+    file = None
+    work = None
     
     chronotopes = [
         'anti-idyll',
@@ -96,108 +111,172 @@ class CCXMLValidator:
     #IMPLIED>
     """
     
-    def __init__(self, file):
-        tree = etree.parse(file)
-        self.xml_element = tree.getroot()
-    
-    def check_xml(self):
+    # Which problems each CC element is checked for, in the order they are reported: (attribute, problem, category, message). A 'missing' problem is an error, an 'invalid' one a warning.
+    checks = {
+        'topos': [
+            ('type', 'invalid', 'nodes', 'Check node type attribute on line '),
+            ('type', 'missing', 'nodes', 'No type attribute on line '),
+            ('framename', 'missing', 'nodes', 'No framename attribute on line ')
+        ],
+        'connection': [
+            ('source', 'missing', 'connections', 'No source attribute on line '),
+            ('target', 'missing', 'connections', 'No target attribute on line '),
+            ('relation', 'invalid', 'connections', 'Check relation attribute on line '),
+            ('relation', 'missing', 'connections', 'No relation attribute on line ')
+        ],
+        'toporef': [
+            ('role', 'missing', 'toporefs', 'No role attribute on line '),
+            ('relation', 'invalid', 'toporefs', 'Check relation attribute on line '),
+            ('relation', 'missing', 'toporefs', 'No relation attribute on line ')
+        ]
+    }
+
+    # Compiled schemas, by the name of the root element they were generated for
+    _schemas = {}
+
+    def __init__(self, file, streaming=False, work=None):
         """
-        Checks for the most common problems with a Chrono-Carto-encoded XML file. 
-        WARNING: this doesn't pick up inconsistencies in the naming of topoi, source and target tags
+        streaming: read the XML incrementally and keep only the attributes and line numbers needed for the checks. The tree is not kept, so check_against_schema and check_against_dtd are unavailable.
+        work: a FramenameIndex of the files of a multi-file work that this file is part of, so that connections can refer to topoi in the other files
         """
+        self.file = file if isinstance(file, str) else None
+        self.work = work
+        if streaming:
+            self.document = CCDocument(file, streaming=True)
+        else:
+            tree = etree.parse(file)
+            self.xml_element = tree.getroot()
+            self.document = CCDocument.from_element(self.xml_element)
 
-        xml_element = self.xml_element
-        chronotopes = self.chronotopes
-        connections = self.connections
-
-        errors = {'nodes': [], 'connections': [], 'toporefs': []}
+    @classmethod
+    def schema_str(cls, root='document'):
+        """
+        Returns an XML Schema for the CC elements, generated from the chronotopes and connections lists. Unlike a DTD, it allows whitespace in values such as 'public square'.
+        Other elements can appear anywhere and are not checked, but topoi, connections and toporefs are checked wherever they appear within them.
+        """
+        def enumeration(name, values):
+            return '<xs:simpleType name="' + name + '"><xs:restriction base="xs:string">' + ''.join('<xs:enumeration value=' + quoteattr(value) + '/>' for value in values) + '</xs:restriction></xs:simpleType>'
+
+        def element(name, attributes):
+            # Attributes are declared in the order that check_against_schema reports them missing
+            return ('<xs:element name="' + name + '"><xs:complexType mixed="true"><xs:complexContent><xs:extension base="content">'
+                + ''.join('<xs:attribute name="' + attribute + '"' + (' type="' + simple_type + '"' if simple_type else '') + ' use="required"/>' for attribute, simple_type in attributes)
+                + '</xs:extension></xs:complexContent></xs:complexType></xs:element>')
+
+        schema = '<xs:schema xmlns:xs="http://www.w3.org/2001/XMLSchema">'
+        schema += '<xs:complexType name="content" mixed="true"><xs:sequence><xs:any minOccurs="0" maxOccurs="unbounded" processContents="lax"/></xs:sequence><xs:anyAttribute processContents="skip"/></xs:complexType>'
+        schema += enumeration('chronotope', cls.chronotopes)
+        schema += enumeration('relation', cls.connections)
+        schema += element('topos', [('type', 'chronotope'), ('framename', None)])
+        schema += element('connection', [('source', None), ('target', None), ('relation', 'relation')])
+        schema += element('toporef', [('role', None), ('relation', 'relation')])
+        # A root in a namespace (eg. TEI's) is declared by root_schema_str instead, as this schema has no namespace of its own
+        if root not in cls.checks and etree.QName(root).namespace is None:
+            schema += '<xs:element name=' + quoteattr(root) + ' type="content"/>'
+        schema += '</xs:schema>'
+        return schema
+
+    @staticmethod
+    def root_schema_str(root):
+        """
+        Returns an XML Schema for a root element in a namespace, given its {namespace}name. The CC elements have no namespace, so their schema (schema_str) is imported into it, as 'cc.xsd'.
+        """
+        name = etree.QName(root)
+        return ('<xs:schema xmlns:xs="http://www.w3.org/2001/XMLSchema" xmlns:root=' + quoteattr(name.namespace) + ' targetNamespace=' + quoteattr(name.namespace) + '>'
+            + '<xs:import schemaLocation="cc.xsd"/>'
+            + '<xs:complexType name="content" mixed="true"><xs:sequence><xs:any namespace="##any" minOccurs="0" maxOccurs="unbounded" processContents="lax"/></xs:sequence><xs:anyAttribute processContents="skip"/></xs:complexType>'
+            + '<xs:element name=' + quoteattr(name.localname) + ' type="root:content"/>'
+            + '</xs:schema>')
+
+    @classmethod
+    def schema(cls, root='document'):
+        """Returns the compiled schema from schema_str, or root_schema_str for a root in a namespace. It is only compiled once for each root element name."""
+        if root not in cls._schemas:
+            if etree.QName(root).namespace is None:
+                cls._schemas[root] = etree.XMLSchema(etree.fromstring(cls.schema_str(root)))
+            else:
+                cc_schema = cls.schema_str(root)
 
-        warnings = {'nodes': [], 'connections': [], 'toporefs': []}
+                class Resolver(etree.Resolver):
+                    def resolve(self, url, pubid, context):
+                        if url == 'cc.xsd':
+                            return self.resolve_string(cc_schema, context)
 
-        sources_and_targets = {'sources': [], 'targets': []}
+                parser = etree.XMLParser()
+                parser.resolvers.add(Resolver())
+                cls._schemas[root] = etree.XMLSchema(etree.fromstring(cls.root_schema_str(root), parser))
+        return cls._schemas[root]
 
-        nodes = []
-        
-        message = ''
+    def check_against_schema(self):
+        """
+        Checks the attributes of every topos, connection and toporef against the compiled schema, which lxml runs in a single pass in C.
+        Returns errors and warnings dicts keyed by kind of element, as in check_xml's report, built from the schema's error log.
+        Only the attributes are checked, not the source and target references, but it's much quicker than the rules on a very large document.
+        """
+        if self.xml_element is None:
+            print('The schema check needs the whole document - create the validator with streaming=False')
+            return
+        errors = {'nodes': [], 'connections': [], 'toporefs': []}
+        warnings = {'nodes': [], 'connections': [], 'toporefs': []}
 
-        for topos in xml_element.iter('topos'):
-            try:
-                topos.attrib['type']
-                if topos.attrib['type'] not in chronotopes:
-                    warnings['nodes'].append(['Check node type attribute on line ' + str(topos.sourceline), topos.attrib])
-            except:
-                errors['nodes'].append(['No type attribute on line ' + str(topos.sourceline), topos.attrib])
-            try:
-                topos.attrib['framename']
-                nodes.append(topos.attrib['framename'])
-            except:
-                errors['nodes'].append(['No framename attribute on line ' + str(topos.sourceline), topos.attrib])
+        schema = self.schema(self.xml_element.tag)
+        if schema.validate(self.xml_element):
+            return errors, warnings
 
+        tree = self.xml_element.getroottree()
 
-        for connection in xml_element.iter('connection'):
-            try:
-                connection.attrib['source']
-            except:
-                errors['connections'].append(['No source attribute on line ' + str(connection.sourceline), connection.attrib])
-            try:
-                connection.attrib['target']
-            except:
-                errors['connections'].append(['No target attribute on line ' + str(connection.sourceline), connection.attrib])
-            try:
-                connection.attrib['relation']
-                if connection.attrib['relation'] not in connections:
-                    warnings['connections'].append(['Check relation attribute on line ' + str(connection.sourceline), connection.attrib])
-            except:
-                errors['connections'].append(['No relation attribute on line ' + str(connection.sourceline), connection.attrib])
+        # Collect the problems with each element, so they can be reported in the order of the checks table
+        problems = {}
+        for entry in schema.error_log:
+            if entry.type_name == 'SCHEMAV_CVC_ENUMERATION_VALID':
+                problem = 'invalid'
+            elif entry.type_name == 'SCHEMAV_CVC_COMPLEX_TYPE_4':
+                problem = 'missing'
+            else:
+                continue
+            attribute = entry.message.split("attribute '", 1)[1].split("'", 1)[0]
+            problems.setdefault(entry.path, set()).add((attribute, problem))
 
+        for path, found in problems.items():
+            el = tree.xpath(path)[0]
+            for attribute, problem, category, message in self.checks[el.tag]:
+                if (attribute, problem) in found:
+                    # The attributes are reported in document order, as they always have been
+                    (errors if problem == 'missing' else warnings)[category].append([message + str(el.sourceline), el.attrib])
 
-        for connection in xml_element.iter('connection'):
-            try:
-                if connection.attrib['source'] not in nodes:
-                    sources_and_targets['sources'].append(['No matching topos for source attribute "' + connection.attrib['source'] + '" on line ' + str(connection.sourceline), connection.attrib])
-                if connection.attrib['target'] not in nodes:
-                    sources_and_targets['targets'].append(['No matching topos for target attribute "' + connection.attrib['target'] + '" on line ' + str(connection.sourceline), connection.attrib])
-            except:
-                print(connection.sourceline, connection.attrib)
+        return errors, warnings
 
+    def validate(self, *sinks):
+        """
+        Runs the rules in validation.RULES over the document in a single pass - the same rules that the Flask app's validator uses.
+        Findings are reported to each sink (eg. validation.TextSink, JSONSink or NDJSONSink), printing them as text if none are given. Returns the engine, whose stats hold the calls, findings and time of every rule.
+        """
+        engine = RuleEngine(sinks=sinks if len(sinks) > 0 else [TextSink()], work=self.work, file=self.file)
 
-        for toporef in xml_element.iter('toporef'):
-            try:
-                toporef.attrib['role']
-            except:
-                errors['toporefs'].append(['No role attribute on line ' + str(toporef.sourceline), toporef.attrib])
-            try:
-                toporef.attrib['relation']
-                if toporef.attrib['relation'] not in connections:
-                    warnings['toporefs'].append(['Check relation attribute on line ' + str(toporef.sourceline), toporef.attrib])
-            except:
-                errors['toporefs'].append(['No relation attribute on line ' + str(toporef.sourceline), toporef.attrib])
+        if self.xml_element is not None:
+            engine.validate(self.xml_element)
+            return engine
 
-        message += 'Errors:\n'
-        
-        if (len(errors['connections']) > 0) or (len(errors['nodes']) > 0) or (len(errors['toporefs']) > 0):
-            message += pprint.pformat(errors)
-        else:
-            message += 'No errors found!\n'
-        
-        message += 'Attribute typos:\n'
-        
-        if (len(warnings['connections']) > 0) or (len(warnings['nodes']) > 0) or (len(warnings['toporefs']) > 0):
-            message += pprint.pformat(warnings)
-        else:
-            message += 'No attribute typos found!\n'
+        # Without the tree, the elements are checked from the document's tables, in document order
+        document = self.document
+        records = [('topos', topos) for topos in document.topoi] + [('connection', connection) for connection in document.connections] + [('toporef', toporef) for toporef in document.toporefs]
+        records.sort(key=lambda record: record[1]['position'])
+        for tag, record in records:
+            engine.check(tag, record['attrib'], record['line'])
+        engine.finish()
+        return engine
 
-        message += 'Source and Target mis-matches:\n'
-        
-        if (len(sources_and_targets['sources']) > 0) or (len(sources_and_targets['targets']) > 0):
-            message += pprint.pformat(sources_and_targets)
-        else:
-            message += 'No mismatches found!\n'
-        
-        print(message)
+    def check_xml(self):
+        """
+        Checks for the most common problems with a Chrono-Carto-encoded XML file, printing the errors, attribute typos and source and target mismatches found by the rules in validation.RULES - see validate and validation.PprintSink.
+        """
+        self.validate(PprintSink())
         
     def check_against_dtd(self, dtd_str):
-        """This works, but the DTD doesn't actually reflect the schema in use, as our attribute values include whitespace, which aren't valid in DTD enumerated values."""
+        """This works, but the DTD doesn't actually reflect the schema in use, as our attribute values include whitespace, which aren't valid in DTD enumerated values. Use check_against_schema instead."""
+        if self.xml_element is None:
+            print('The DTD check needs the whole document - create the validator with streaming=False')
+            return
         f = StringIO(dtd_str)
         dtd = etree.DTD(f)
         if dtd.validate(self.xml_element) == True:
@@ -212,47 +291,175 @@ class GraphGenerator():
     """Base class for all other CC graph generation classes"""
     
     graph = None
-    xml_element = None
+    document = None
     xml_dir = None
     output_root = None
     output_dir = None
     output_file = None
     file = None
+    cache_dir = None
+    
+    # Node positions by layout key, shared by every generator, least recently used first - see layout
+    _layouts = OrderedDict()
+    
+    # How many layouts are kept in memory. Older ones are still in cache_dir.
+    max_layouts = 16
     
-    def __init__(self, file, xml_dir='files/xml/', output_dir='files/graphs/', output_root=None, svg_dir='files/svg/'):
+    # The node attributes that each layout algorithm depends on, besides the nodes and edges, which are part of its key
+    layout_attributes = {'barnes_hut': ['length'], 'timeline': ['chronotope', 'chronotopes', 'time_indices', 'timeframes']}
+    
+    # Whether the graph tends to fall into many separate components (eg. isolated settings), which are better laid out one at a time and packed together
+    pack_components = False
+    
+    # Layouts of small components by shape, shared by every generator, least recently used first - see packed_layout
+    _shapes = OrderedDict()
+    
+    # How many shapes are kept
+    max_shapes = 1000
+    
+    def __init__(self, file, xml_dir='files/xml/', output_dir='files/graphs/', output_root=None, svg_dir='files/svg/', document=None, streaming=False, cache_dir='files/cache/', parallel=False):
         """
         Parses the XML, creates an empty graph, and prepares the output directories and files.
+        If a CCDocument has already been built from the file, it can be passed as document to avoid parsing the XML again.
+        streaming: read the XML incrementally rather than building the whole tree - useful for very large files
+        parallel: parse the chapters of the XML in separate processes, then merge them - useful for very long works
+        cache_dir: where parsed documents and layouts are cached between runs - set to None to always parse the XML, and only keep layouts in memory
         """
         # Load the XML. If a file-like object has been passed rather than a path to a file, then the output_root property will not be generated from the file name, so needs to be set using the output_root parameter.
-        try:
-            tree = etree.parse(xml_dir + file)
-        except:
-            tree = etree.parse(file)
+        if document is None:
+            document = load_document(file, xml_dir=xml_dir, cache_dir=cache_dir, streaming=streaming, parallel=parallel)
         
         if output_root != None:
             self.output_root = output_root
         else:
             self.output_root = file[:-4]
             
-        self.xml_element = tree.getroot()
+        self.document = document
         self.graph = nx.DiGraph()
         self.output_dir = output_dir
         self.xml_dir = xml_dir
         self.svg_dir = svg_dir
         self.file = file
+        self.cache_dir = cache_dir
     
-    def layout(self, algorithm='kamada', scale=10):
-        """Lay out the graph using networkx's built in algorithms"""
-        if algorithm == 'kamada':
-            pos = nx.kamada_kawai_layout(self.graph, center=[0,0], scale=scale)
-        elif algorithm == 'spring':
-            pos = nx.spring_layout(self.graph, center=[0,0], scale=scale, iterations=100)
-        elif algorithm == 'spectral':
-            pos = nx.spectral_layout(self.graph, center=[0,0], scale=scale)
+    def layout(self, algorithm='kamada', scale=10, seed=None, warm_start=None, pin=True, processes=None):
+        """
+        Lay out the graph using networkx's built in algorithms, or for large graphs (eg. complete graphs of long novels) 'barnes_hut' or 'stress' - see layouts.barnes_hut_layout and layouts.stress_layout.
+        'stress' gives much the same kind of layout as 'kamada', in a fraction of the time and memory.
+        'timeline' lays the nodes out in the order they appear in the text, in a lane for each chronotope, for syuzhet and temporal graphs - see appearances and layouts.timeline_layout.
+        Layouts are memoised, in memory and in cache_dir, under a hash of the graph's nodes and edges and the layout settings, so laying out a graph that hasn't changed (eg. for a second export, or after a restart) skips the layout itself.
+        seed: the random seed for the spring and barnes_hut layouts - without one, the first layout of a graph is the one kept
+        warm_start: a .graphml or .gexf file, eg. an earlier export that has been adjusted in Gephi, or {node: (x, y)}. Nodes keep the positions they have there, and only new nodes are placed, by a few rounds of layouts.warm_layout, so re-coding a little more of the text doesn't undo the work of laying the graph out by hand.
+        If none of the graph's nodes have positions there, it is laid out afresh by algorithm.
+        pin: with warm_start, whether nodes with positions stay exactly where they were, or may move a little to make room for new ones
+        Graphs of generators with pack_components set are laid out a component at a time, and the components packed together - see packed_layout. processes is the number of worker processes for that.
+        """
+        # A timeline keeps every component on the same time axis, so isn't packed
+        packed = self.pack_components and algorithm != 'timeline'
+        known = None
+        if warm_start is not None:
+            known = read_positions(warm_start) if isinstance(warm_start, str) else {str(node): position for node, position in warm_start.items()}
+            known = {node: known[str(node)] for node in self.graph.nodes if str(node) in known}
+        if known:
+            key = fingerprint({'graph': graph_hash(self.graph), 'algorithm': 'warm', 'known': sorted([str(node), x, y] for node, (x, y) in known.items()), 'pin': pin, 'seed': seed})
+        else:
+            inputs = {'graph': graph_hash(self.graph, self.layout_attributes.get(algorithm, [])), 'algorithm': algorithm, 'scale': scale, 'seed': seed, 'packed': packed}
+            if algorithm == 'timeline':
+                # Nodes without an index are placed in the order they were added
+                inputs['order'] = [str(node) for node in self.graph.nodes]
+            key = fingerprint(inputs)
+        
+        pos = self._layouts.get(key)
+        if pos is not None:
+            self._layouts.move_to_end(key)
+        if pos is None:
+            pos = self.load_layout(key)
+        if pos is None and known:
+            # Positions from a file are already in the units of the drawing
+            pos = warm_layout(self.graph, known, pin=pin, seed=seed)
+            pos = {node: (float(x), float(y)) for node, (x, y) in pos.items()}
+            self.save_layout(key, pos)
+        if pos is None:
+            if packed:
+                pos = packed_layout(self.graph, algorithm=algorithm, scale=scale, seed=seed, processes=processes, shapes=self._shapes)
+                while len(self._shapes) > self.max_shapes:
+                    self._shapes.popitem(last=False)
+            else:
+                pos = layout_graph(self.graph, algorithm=algorithm, scale=scale, seed=seed)
+            
+            pos = {node: (float(coords[0]) * 100, float(coords[1]) * 100) for node, coords in pos.items()}
+            self.save_layout(key, pos)
+        self._layouts[key] = pos
+        while len(self._layouts) > self.max_layouts:
+            self._layouts.popitem(last=False)
         
-        for node, coords in pos.items():
-            self.graph.nodes[node]['x'] = coords[0] * 100
-            self.graph.nodes[node]['y'] = coords[1] * 100
+        for node, (x, y) in pos.items():
+            self.graph.nodes[node]['x'] = x
+            self.graph.nodes[node]['y'] = y
+    
+    def layout_file(self, key):
+        """Where the layout with this key is kept on disk, or None if layouts are only kept in memory"""
+        if self.cache_dir is None:
+            return None
+        return os.path.join(self.cache_dir, 'layouts', key + '.json')
+    
+    def load_layout(self, key):
+        """Returns the node positions saved under key, or None if there aren't any for every node of the graph"""
+        layout_file = self.layout_file(key)
+        if layout_file is None:
+            return None
+        try:
+            with open(layout_file) as f:
+                pos = {node: (x, y) for node, x, y in json.load(f)['positions']}
+        except (OSError, ValueError, KeyError):
+            return None
+        if any(node not in pos for node in self.graph.nodes):
+            return None
+        return pos
+    
+    def save_layout(self, key, pos):
+        """Save node positions under key. Failing to write the cache shouldn't stop the graph being drawn."""
+        layout_file = self.layout_file(key)
+        if layout_file is None:
+            return
+        try:
+            os.makedirs(os.path.dirname(layout_file), exist_ok=True)
+            with open(layout_file + '.' + str(os.getpid()) + '.tmp', 'w') as f:
+                f.write(json.dumps({'positions': [[node, x, y] for node, (x, y) in pos.items()]}))
+            os.replace(layout_file + '.' + str(os.getpid()) + '.tmp', layout_file)
+        except (OSError, TypeError):
+            pass
+    
+    @classmethod
+    def artifact(cls, output_root, source_hash, kind, **params):
+        """
+        The key and inputs under which one kind of output ('gexf', 'graphml' or 'svg') of this generator is recorded in an ArtifactStore.
+        Any layout or style settings the output depends on are passed as params.
+        """
+        key = output_root + '|' + cls.__name__ + '|' + kind
+        inputs = {'source_hash': source_hash, 'model_version': MODEL_VERSION, 'generator': cls.__name__, 'kind': kind}
+        inputs.update(params)
+        return key, inputs
+    
+    def artifact_dir(self, kind):
+        """The directory an output kind is written to, which holds its ArtifactStore"""
+        if kind == 'svg':
+            return self.svg_dir
+        return self.output_dir
+    
+    def is_current(self, kind, **params):
+        """Whether this kind of output was last built from the same XML and settings, and is still there. Outputs of file-like objects are never current."""
+        if self.document.source_hash is None:
+            return False
+        key, inputs = self.artifact(self.output_root, self.document.source_hash, kind, **params)
+        return ArtifactStore(self.artifact_dir(kind)).is_current(key, inputs)
+    
+    def record(self, kind, output_file, **params):
+        """Record the inputs an output has just been built from"""
+        if self.document.source_hash is None:
+            return
+        key, inputs = self.artifact(self.output_root, self.document.source_hash, kind, **params)
+        ArtifactStore(self.artifact_dir(kind)).record(key, inputs, output_file)
     
     def write_gexf(self):
         """Write the graph to gexf"""
@@ -260,6 +467,7 @@ class GraphGenerator():
         with open(self.output_dir + output_file, 'w') as output_file:
             for line in nx.readwrite.gexf.generate_gexf(self.graph):
                 output_file.write(line)
+        self.record('gexf', self.output_dir + self.output_root + self.output_suffix + '.gexf')
 
     def write_graphml(self):
         """Write the graph to graphml"""
@@ -267,6 +475,7 @@ class GraphGenerator():
         with open(self.output_dir + output_file, 'w') as output_file:
             for line in nx.readwrite.graphml.generate_graphml(self.graph):
                 output_file.write(line)
+        self.record('graphml', self.output_dir + self.output_root + self.output_suffix + '.graphml')
                 
     def write_json(self):
         """Write the graph to json"""
@@ -275,7 +484,7 @@ class GraphGenerator():
     def write_geojson(self):
         """Write the graph to geojson"""
         
-        # First, lay out the graph
+        # First, lay out the graph. If it's already been laid out, eg. by write_svg, the layout comes from the cache.
         self.layout()
         
         geo_dict = {
@@ -327,14 +536,170 @@ class GraphGenerator():
             file.write(geojson)
     
     
-    def write_svg(self, algorithm='kamada', node_scale=1, size=1.0, scale_correction=700):
-        self.layout(algorithm=algorithm)
-        svggen = GraphToSvg(graph=self.graph)
+    def write_svg(self, algorithm='kamada', node_scale=1, size=1.0, scale_correction=700, force=False, warm_start=None):
+        """
+        Lay out the graph and draw it to svg. If the svg was last drawn from the same XML with the same settings, the layout and drawing are skipped, unless force is set.
+        warm_start: a .graphml or .gexf file to take node positions from - see layout
+        """
         output_file = self.output_root + self.output_suffix + '.svg'
+        params = {'algorithm': algorithm, 'node_scale': node_scale, 'size': size, 'scale_correction': scale_correction, 'curved': True, 'style': colour_style}
+        if warm_start is not None:
+            params['warm_start'] = file_hash(warm_start)
+        if not force and self.is_current('svg', **params):
+            return 'files/svg/' + output_file
+        
+        self.layout(algorithm=algorithm, warm_start=warm_start)
+        svggen = GraphToSvg(graph=self.graph)
         svggen.draw_graph(output_file=self.svg_dir + output_file, style=colour_style, curved=True, node_scale=node_scale, size=size, scale_correction=scale_correction)
+        self.record('svg', self.svg_dir + output_file, **params)
         return 'files/svg/' + output_file
         
         
+def layout_graph(graph, algorithm='kamada', scale=10, seed=None):
+    """Lay out a graph with one of the algorithms of GraphGenerator.layout, returning {node: (x, y)} no further than scale from 0,0"""
+    if algorithm == 'kamada':
+        return nx.kamada_kawai_layout(graph, center=[0,0], scale=scale)
+    elif algorithm == 'spring':
+        return nx.spring_layout(graph, center=[0,0], scale=scale, iterations=100, seed=seed)
+    elif algorithm == 'spectral':
+        return nx.spectral_layout(graph, center=[0,0], scale=scale)
+    elif algorithm == 'barnes_hut':
+        return barnes_hut_layout(graph, scale=scale, seed=seed)
+    elif algorithm == 'stress':
+        return stress_layout(graph, scale=scale)
+    elif algorithm == 'timeline':
+        first, lane = appearances(graph)
+        return timeline_layout(graph, first, lane, scale=scale)
+    raise ValueError(f'Unknown layout algorithm: {algorithm}')
+
+
+# Components up to this many nodes are laid out once per shape, and larger ones are worth a process of their own
+SMALL_COMPONENT = 12
+LARGE_COMPONENT = 100
+
+
+def packed_layout(graph, algorithm='kamada', scale=10, seed=None, processes=None, shapes=None):
+    """
+    Lay out each weakly connected component of a graph on its own, then pack them together, so that components sit side by side rather than being pushed to the edges of one big layout.
+    - Each component is laid out at a size that grows with the square root of its nodes, so nodes are spaced much the same in all of them.
+    - Small components (up to SMALL_COMPONENT nodes) are laid out once per shape: shapes maps the degrees of a component's nodes to the components of that shape laid out so far, and a component isomorphic to one of them reuses its layout. Passing the same dict between calls shares them between graphs. The shapes used most recently are moved to its end, so the caller can drop the least recently used from the front.
+    - If there is more than one large component (over LARGE_COMPONENT nodes), they are laid out in a pool of processes worker processes, which defaults to the number of CPUs.
+    - The components' bounding boxes are then packed by layouts.pack, largest first.
+    Returns {node: (x, y)} no further than scale from 0,0.
+    """
+    if shapes is None:
+        shapes = {}
+    if graph.is_directed():
+        components = [graph.subgraph(nodes).copy() for nodes in nx.weakly_connected_components(graph)]
+    else:
+        components = [graph.subgraph(nodes).copy() for nodes in nx.connected_components(graph)]
+    if len(components) == 0:
+        return {}
+    # A fixed order, so that the same graph is always packed the same way
+    components.sort(key=lambda component: (-len(component), sorted(str(node) for node in component.nodes)))
+    
+    positions = [None] * len(components)
+    large = [i for i, component in enumerate(components) if len(component) > LARGE_COMPONENT]
+    if processes is None:
+        processes = os.cpu_count()
+    if len(large) > 1 and processes > 1:
+        with ProcessPoolExecutor(max_workers=min(processes, len(large))) as pool:
+            futures = {i: pool.submit(layout_graph, components[i], algorithm, math.sqrt(len(components[i])), seed) for i in large}
+            for i, future in futures.items():
+                positions[i] = future.result()
+    
+    for i, component in enumerate(components):
+        if positions[i] is not None:
+            continue
+        if len(component) == 1:
+            positions[i] = {node: (0.0, 0.0) for node in component.nodes}
+        elif len(component) <= SMALL_COMPONENT:
+            positions[i] = shape_layout(component, algorithm, seed, shapes)
+        else:
+            positions[i] = layout_graph(component, algorithm, math.sqrt(len(component)), seed)
+    
+    # Pack the components' bounding boxes, and move each component into its place
+    arrays = [np.array([pos[node] for node in component.nodes], dtype=float).reshape(-1, 2) for component, pos in zip(components, positions)]
+    lows = np.array([array.min(axis=0) for array in arrays])
+    corners = pack(np.array([array.max(axis=0) for array in arrays]) - lows)
+    packed = rescale(np.concatenate([array - low + corner for array, low, corner in zip(arrays, lows, corners)]), scale)
+    
+    nodes = [node for component in components for node in component.nodes]
+    return {node: (packed[i, 0], packed[i, 1]) for i, node in enumerate(nodes)}
+
+
+def shape_layout(component, algorithm, seed, shapes):
+    """Lay out a small component, reusing the layout of any isomorphic component in shapes, and adding it to shapes if there isn't one"""
+    # Components with the same degrees might be the same shape, and are checked for a match node by node
+    if component.is_directed():
+        degrees = sorted(zip(dict(component.in_degree).values(), dict(component.out_degree).values()))
+    else:
+        degrees = sorted(dict(component.degree).values())
+    key = (algorithm, seed, component.is_directed(), tuple(degrees))
+    matcher = nx.algorithms.isomorphism.DiGraphMatcher if component.is_directed() else nx.algorithms.isomorphism.GraphMatcher
+    laid_out = shapes.pop(key, [])
+    shapes[key] = laid_out
+    for shape, pos in laid_out:
+        match = matcher(shape, component)
+        if match.is_isomorphic():
+            return {match.mapping[node]: xy for node, xy in pos.items()}
+    
+    pos = layout_graph(component, algorithm, math.sqrt(len(component)), seed)
+    laid_out.append((component, pos))
+    return pos
+
+
+def appearances(graph):
+    """
+    Returns when each node of a graph first appears in the text, as {node: index}, and its chronotope, as {node: type}, for a timeline layout.
+    The index is the earliest of a node's time_indices (TemporalTopoiGraphGenerator) or timeframes (generate_simple), or else of the source_index or target_index of its edges. Nodes with none of these, eg. in a syuzhet graph, were added in order of appearance, so their index is their place in the graph.
+    A node's chronotope is its chronotope, or the first of its chronotopes.
+    """
+    edge_first = {}
+    for source, target, data in graph.edges(data=True):
+        for node, attribute in ((source, 'source_index'), (target, 'target_index')):
+            if data.get(attribute) is not None:
+                edge_first[node] = min(edge_first.get(node, data[attribute]), data[attribute])
+    
+    first = {}
+    lane = {}
+    for place, (node, data) in enumerate(graph.nodes(data=True)):
+        indices = data.get('time_indices', data.get('timeframes'))
+        if indices:
+            first[node] = min(int(index) for index in str(indices).split(','))
+        else:
+            first[node] = edge_first.get(node, place)
+        lane[node] = data.get('chronotope', str(data.get('chronotopes', '')).split(',')[0].strip())
+    return first, lane
+
+
+def read_positions(file):
+    """
+    Returns {node: (x, y)} for the nodes of a .graphml or .gexf file that have positions, with nodes named by their ids.
+    Positions are read from the x and y attributes that write_graphml and write_gexf save, or in a gexf, from viz:position, where Gephi keeps the positions it has been given.
+    """
+    if file.endswith('.gexf'):
+        graph = nx.read_gexf(file)
+    else:
+        graph = nx.read_graphml(file)
+    positions = {}
+    for node, data in graph.nodes(data=True):
+        position = data.get('viz', {}).get('position', data)
+        if position.get('x') is not None and position.get('y') is not None:
+            positions[str(node)] = (float(position['x']), float(position['y']))
+    return positions
+
+
+def graph_hash(graph, attributes=()):
+    """A hash of a graph's nodes and edges, and of any of the nodes' attributes named, which doesn't depend on the order they were added in"""
+    if graph.is_directed():
+        edges = sorted([str(source), str(target)] for source, target in graph.edges)
+    else:
+        edges = sorted(sorted([str(source), str(target)]) for source, target in graph.edges)
+    nodes = sorted([str(node)] + [str(data.get(attribute)) for attribute in attributes] for node, data in graph.nodes(data=True))
+    return fingerprint({'directed': graph.is_directed(), 'nodes': nodes, 'edges': edges})
+
+
 class CompleteGraphGenerator(GraphGenerator):
     """A complete spatial graph, containing all toporefs and topoi"""
     
@@ -342,95 +707,60 @@ class CompleteGraphGenerator(GraphGenerator):
         self.output_suffix = '-complete'
         
         graph = self.graph
-        xml_element = self.xml_element
+        document = self.document
         
+        # Work through the toporefs once, collecting their nodes, the edges to their containing topoi, and the chain of edges along each sequence.
+        # The first toporef in a sequence hangs off its containing topos, and every one after it off the toporef before.
+        # Each toporef is chained once. (This used to list a sequence's toporefs once for every sequence in the document, so a document with more than one sequence also got an edge from each sequence's last toporef back to its first - a self-loop when the sequence only had one.)
+        toporef_nodes = []
+        containing_edges = []
+        sequence_edges = {}
+
+        for toporef in document.toporefs:
+            node = '"' + toporef['text'] + '"'
+            toporef_nodes.append(node)
+
+            if 'sequence' not in toporef['attrib']:
+                containing_edges.append((toporef['parent'], node, toporef['attrib'].get('relation', 'none')))
+            elif toporef['attrib']['sequence'] not in sequence_edges:
+                sequence_edges[toporef['attrib']['sequence']] = [(toporef['parent'], node, toporef['attrib'].get('relation', 'none'))]
+            else:
+                chain = sequence_edges[toporef['attrib']['sequence']]
+                chain.append((chain[-1][1], node, toporef['attrib']['relation']))
+
         # Add all the litonyms and topoi as nodes and connections as edges first
-        for toporef in xml_element.iter('toporef'):
-            graph.add_node('"' + toporef.text + '"', node_type='toporef')
+        for node in toporef_nodes:
+            graph.add_node(node, node_type='toporef')
 
         topos_count = 0
 
-        for topos in xml_element.iter('topos'):
+        for topos in document.topoi:
             topos_count_str = str(topos_count)
             try:
-                framename = topos.attrib['framename']
-                new_length = graph.nodes[framename]['length'] + len(''.join(topos.itertext()).strip())
+                framename = topos['attrib']['framename']
+                new_length = graph.nodes[framename]['length'] + topos['length']
                 graph.nodes[framename]['length'] = new_length
                 graph.nodes[framename]['timeframes'] = graph.nodes[framename]['timeframes'] + ',' + topos_count_str
 
             except KeyError:
-                graph.add_node(topos.attrib['framename'], length=len(''.join(topos.itertext()).strip()), chronotope=topos.attrib['type'], node_type="topos", timeframes=topos_count_str)
+                graph.add_node(topos['attrib']['framename'], length=topos['length'], chronotope=topos['attrib']['type'], node_type="topos", timeframes=topos_count_str)
 
             topos_count += 1
 
-        for connection in xml_element.iter('connection'):
+        for connection in document.connections:
             try:
-                graph.add_edge(connection.attrib['source'], connection.attrib['target'], relation=connection.attrib['relation'])
+                graph.add_edge(connection['attrib']['source'], connection['attrib']['target'], relation=connection['attrib']['relation'])
             except:
-                graph.add_edge(connection.attrib['source'], connection.attrib['target'], relation='none')
+                graph.add_edge(connection['attrib']['source'], connection['attrib']['target'], relation='none')
 
         # Connect the toporefs to the containing topoi
-        for toporef in xml_element.iter('toporef'):
-            if ('sequence' in toporef.attrib.keys()):
-                pass
-            else:
-                parent = toporef.getparent()
-                containing_node = None
-                if parent.tag == 'topos':
-                    containing_node = parent.attrib['framename']
-                elif parent.tag == 'connection':
-                    containing_topos = parent.getparent()
-                    try:
-                        containing_node = containing_topos.attrib['framename']
-                    except:
-                        pass
-                try:
-                    graph.add_edge(containing_node, '"' + toporef.text + '"', relation=toporef.attrib['relation'])
-                except:
-                    graph.add_edge(containing_node, '"' + toporef.text + '"', relation='none')
+        for source, target, relation in containing_edges:
+            graph.add_edge(source, target, relation=relation)
 
         # Connect the toporef sequences to one another
-        sequences = {}
-        for toporef in xml_element.iter('toporef'):
-            try:
-                sequence = toporef.attrib['sequence']
-                sequences[sequence] = []
-            except:
-                pass
-
-        for sequence in sequences.keys():
-            for toporef in xml_element.iter('toporef'):
-                try:
-                    sequence = toporef.attrib['sequence']
-                    sequences[sequence].append(toporef)
-                except:
-                    pass
-
-        for sequence, toporef_list in sequences.items():
-            prev_toporef = None
-
-            for toporef in toporef_list:    
-                if prev_toporef == None:
-                    parent = toporef.getparent()
-                    containing_node = None
-                    if parent.tag == 'topos':
-                        containing_node = parent.attrib['framename']
-                    elif parent.tag == 'connection':
-                        containing_topos = parent.getparent()
-                        try:
-                            containing_node = containing_topos.attrib['framename']
-                        except:
-                            pass
-                    try:
-                        graph.add_edge(containing_node, '"' + toporef.text + '"', relation=toporef.attrib['relation'])
-                    except:
-                        graph.add_edge(containing_node, '"' + toporef.text + '"', relation='none')
-
-                    prev_toporef = toporef
-
-                else:
-                    graph.add_edge('"' + prev_toporef.text + '"', '"' + toporef.text + '"', relation=toporef.attrib['relation'])
-                    prev_toporef = toporef
+        for sequence, chain in sequence_edges.items():
+            for source, target, relation in chain:
+                graph.add_edge(source, target, relation=relation)
 
                     
 class SyuzhetGraphGenerator(GraphGenerator):
@@ -441,12 +771,20 @@ class SyuzhetGraphGenerator(GraphGenerator):
 
         self.output_suffix = '-syuzhet'
         graph = self.graph
-        xml_element = self.xml_element
+        document = self.document
         
         topoi = []
 
-        for topos in xml_element.iter('topos'):
-            topoi.append([topos.attrib['framename'], topos.attrib['type'], len(''.join(topos.itertext()).strip())])
+        for topos in document.topoi:
+            topoi.append([topos['attrib']['framename'], topos['attrib']['type'], topos['length']])
+
+        # (source, target) -> connection attributes. Where a pair is connected more than once, the last connection in the text wins.
+        connections = {}
+        for c in document.connections:
+            try:
+                connections[(c['attrib']['source'], c['attrib']['target'])] = c['attrib']
+            except KeyError:
+                pass
 
         prev_node = None
 
@@ -460,38 +798,36 @@ class SyuzhetGraphGenerator(GraphGenerator):
                 except KeyError:
                     graph.add_node(t[0], chronotope=t[1], length=t[2])
 
-                connection = None
-
-                for c in xml_element.iter('connection'):
-                    if (c.attrib['source'] == prev_node) and (c.attrib['target'] == t[0]):
-                        graph.add_edge(prev_node, t[0], relation=c.attrib['relation'])
-                        connection = [prev_node, t[0], c.attrib['relation']]
-                    else:
-                        #graph.add_edge(prev_node, t[0], relation='none')
-                        connection = [prev_node, t[0], 'none']
+                # Only connect consecutive topoi where the text codes a connection between them
+                c = connections.get((prev_node, t[0]))
+                if c is not None:
+                    graph.add_edge(prev_node, t[0], relation=c['relation'])
 
                 prev_node = t[0]
 
 
 class TopoiGraphGenerator(GraphGenerator):
+    # Settings that no connection leads to are components of their own
+    pack_components = True
+    
     def generate(self):
         """
-        Iterate over an XML element and its children and generate a graph of topoi nodes and connections, including attributes.
+        Iterate over the topoi and connections of a document and generate a graph of topoi nodes and connections, including attributes.
         """
         
         self.output_suffix = '-topoi'
         graph = self.graph
-        xml_element = self.xml_element
+        document = self.document
         
-        for topos in xml_element.iter('topos'):
+        for topos in document.topoi:
             try:
-                graph.nodes[topos.attrib['framename']]['length'] += len(''.join(topos.itertext()).strip())
+                graph.nodes[topos['attrib']['framename']]['length'] += topos['length']
             except KeyError:
-                graph.add_node(topos.attrib['framename'], chronotope=topos.attrib['type'], length=len(''.join(topos.itertext()).strip()))
+                graph.add_node(topos['attrib']['framename'], chronotope=topos['attrib']['type'], length=topos['length'])
 
-        for c in xml_element.iter('connection'):
+        for c in document.connections:
             try:
-                graph.add_edge(c.attrib['source'], c.attrib['target'], relation=c.attrib['relation'])
+                graph.add_edge(c['attrib']['source'], c['attrib']['target'], relation=c['attrib']['relation'])
             except KeyError:
                 pass
 
@@ -499,42 +835,39 @@ class TopoiGraphGenerator(GraphGenerator):
 class TemporalTopoiGraphGenerator(GraphGenerator):
     def generate(self):
         """
-        Takes an XML element and sequentially builds a populated graph of topoi, recording the temporal index, size, and chronotope 
+        Takes a document and sequentially builds a populated graph of topoi, recording the temporal index, size, and chronotope 
         of each as they are encountered, and the temporal index of the connecting edges.
         """
         
         self.output_suffix = '-temporal-topoi'
         graph = self.graph
-        xml_element = self.xml_element
+        document = self.document
         
         topoi = {}
         connections = []
-        index = 0
-
-        for el in xml_element.iter():
-            if el.tag == 'topos':
-                if el.attrib['framename'] not in topoi.keys():
-                    topoi[el.attrib['framename']] = {}
-                    topoi[el.attrib['framename']]['chronotopes'] = [el.attrib['type']]
-                    topoi[el.attrib['framename']]['timeframes'] = [str(index)]
-                    topoi[el.attrib['framename']]['text_lengths'] = [str(len(el.text))]
-                else:
-                    topoi[el.attrib['framename']]['chronotopes'].append(el.attrib['type'])
-                    topoi[el.attrib['framename']]['timeframes'].append(str(index))
-                    topoi[el.attrib['framename']]['text_lengths'].append(str(len(el.text)))
-
 
-
-            if el.tag == 'connection':
-                connection = {}
-                connection['source'] = el.attrib['source']
-                connection['target'] = el.attrib['target']
-                connection['relation'] = el.attrib['relation']
-                connection['source_index'] = index 
-                connection['target_index'] = index +1
-                connections.append(connection)
-
-                index = index +1
+        # The temporal index of a topos is the number of connections that precede it in the text
+        for topos in document.topoi:
+            attrib = topos['attrib']
+            index = topos['time_index']
+            if attrib['framename'] not in topoi.keys():
+                topoi[attrib['framename']] = {}
+                topoi[attrib['framename']]['chronotopes'] = [attrib['type']]
+                topoi[attrib['framename']]['timeframes'] = [str(index)]
+                topoi[attrib['framename']]['text_lengths'] = [str(topos['text_length'])]
+            else:
+                topoi[attrib['framename']]['chronotopes'].append(attrib['type'])
+                topoi[attrib['framename']]['timeframes'].append(str(index))
+                topoi[attrib['framename']]['text_lengths'].append(str(topos['text_length']))
+
+        for index, el in enumerate(document.connections):
+            connection = {}
+            connection['source'] = el['attrib']['source']
+            connection['target'] = el['attrib']['target']
+            connection['relation'] = el['attrib']['relation']
+            connection['source_index'] = index 
+            connection['target_index'] = index +1
+            connections.append(connection)
 
         for node, attributes in topoi.items():
             chronotopes = ', '.join(attributes['chronotopes'])
@@ -548,89 +881,132 @@ class TemporalTopoiGraphGenerator(GraphGenerator):
 
     def generate_simple(self):
         """
-        Takes an XML element and builds a graph of topoi, recording only timeframes
+        Takes a document and builds a graph of topoi, recording only timeframes
         """
         self.output_suffix = '-temporal-topoi-simple'
         graph = self.graph
-        xml_element = self.xml_element
+        document = self.document
         
         graph.clear()
         
         topos_count = 0
     
-        for topos in xml_element.iter('topos'):
+        for topos in document.topoi:
+            attrib = topos['attrib']
             topos_count_string = str(topos_count)
             try:
-                graph.nodes[topos.attrib['framename']]['length'] += len(''.join(topos.itertext()).strip())
-                timeframes = graph.nodes[topos.attrib['framename']]['timeframes'] + ',' + topos_count_string 
-                graph.nodes[topos.attrib['framename']]['timeframes'] = timeframes
+                graph.nodes[attrib['framename']]['length'] += topos['length']
+                timeframes = graph.nodes[attrib['framename']]['timeframes'] + ',' + topos_count_string 
+                graph.nodes[attrib['framename']]['timeframes'] = timeframes
             except KeyError:
-                graph.add_node(topos.attrib['framename'], chronotope=topos.attrib['type'], length=len(''.join(topos.itertext()).strip()), timeframes=topos_count_string)
+                graph.add_node(attrib['framename'], chronotope=attrib['type'], length=topos['length'], timeframes=topos_count_string)
 
             topos_count += 1
 
 
-        for c in xml_element.iter('connection'):
+        for c in document.connections:
             try:
-                graph.add_edge(c.attrib['source'], c.attrib['target'], relation=c.attrib['relation'])
+                graph.add_edge(c['attrib']['source'], c['attrib']['target'], relation=c['attrib']['relation'])
             except KeyError:
                 pass
 
 class TopoiAndArchetypeGraphGenerator(GraphGenerator):
     def generate(self):
         """
-        Takes an XML element marked up using CLAYE and returns a populated graph of the topoi and their associated chronotopes
+        Takes a document marked up using CLAYE and returns a populated graph of the topoi and their associated chronotopes
         """
         
         self.output_suffix = '-topoi-and-chronotopic-archetypes'
         graph = self.graph
-        xml_element = self.xml_element
+        document = self.document
         
-        for topos in xml_element.iter('topos'):
-            graph.add_node(topos.attrib['type'], node_type='chronotope')
-            graph.add_node(topos.attrib['framename'], node_type='setting')
-            graph.add_edge(topos.attrib['type'], topos.attrib['framename'])
+        for topos in document.topoi:
+            graph.add_node(topos['attrib']['type'], node_type='chronotope')
+            graph.add_node(topos['attrib']['framename'], node_type='setting')
+            graph.add_edge(topos['attrib']['type'], topos['attrib']['framename'])
 
 
 class DeepChronotopesGraphGenerator(GraphGenerator):
     def generate(self):
         """
-        Creates a 'deep' chronotopes map, ie. the distribution of chronotopes across a text, and how they are connected with one another. Uses Beautifulsoup instead of eTree because XML is a nightmare.
+        Creates a 'deep' chronotopes map, ie. the distribution of chronotopes across a text, and how they are connected with one another.
+        The chronotope of a connection's source or target is that of the nearest topos with the same framename, looking back through the text first, and then forward.
         """
         
-        with open(self.xml_dir + self.file) as fp:
-            soup = BeautifulSoup(fp, features="lxml")
-        
         self.output_suffix = '-deep-chronotopes'
         graph = self.graph
+        document = self.document
+        topoi = document.topoi
         
+        # Index the position and chronotope of every typed topos by framename, in document order. Topoi without a type never decide a connection's chronotopes, so they are left out.
+        index = {}
+        for topos in topoi:
+            chronotope = topos['attrib'].get('type')
+            if chronotope is None:
+                continue
+            positions, chronotopes = index.setdefault(topos['attrib'].get('framename'), ([], []))
+            positions.append(topos['position'])
+            chronotopes.append(chronotope)
+
+        def preceding(framename, position, count=1):
+            """The chronotopes of the nearest topoi named framename before position, nearest first"""
+            positions, chronotopes = index.get(framename, ([], []))
+            i = bisect.bisect_left(positions, position)
+            return chronotopes[max(0, i - count):i][::-1]
+
+        def following(framename, position, count=1):
+            """The chronotopes of the nearest topoi named framename after position, nearest first"""
+            positions, chronotopes = index.get(framename, ([], []))
+            i = bisect.bisect_right(positions, position)
+            return chronotopes[i:i + count]
+
         # Add all the connections first
         edges = []
-        for connection in soup.find_all('connection'):
-            source = connection.get('source')
-            target = connection.get('target')
-            relation = connection.get('relation')
+        for connection in document.connections:
+            source = connection['attrib'].get('source')
+            target = connection['attrib'].get('target')
+            relation = connection['attrib'].get('relation')
+            position = connection['position']
 
             source_chronotope = None
             target_chronotope = None
 
-            if (connection.parent.get('framename') == source):
-                source_chronotope = connection.parent.get('type')
+            parent = None
+            if connection['parent'] is not None:
+                parent = topoi[connection['parent']]['attrib']
+
+            # Look back through the text, unless the connection sits in its source topos. When the source and target are the same, the nearest topos is the source and the next nearest the target.
+            if (parent is not None and parent.get('framename') == source):
+                source_chronotope = parent.get('type')
+
+            elif source == target:
+                found = preceding(source, position, count=2)
+                if len(found) > 0:
+                    source_chronotope = found[0]
+                if len(found) > 1:
+                    target_chronotope = found[1]
+
+            else:
+                for chronotope in preceding(source, position):
+                    source_chronotope = chronotope
+                for chronotope in preceding(target, position):
+                    target_chronotope = chronotope
+
+            # Then look forward for anything still missing, filling in the target first
+            if source == target:
+                for chronotope in following(target, position, count=2):
+                    if target_chronotope is None:
+                        target_chronotope = chronotope
+                    elif source_chronotope is None:
+                        source_chronotope = chronotope
 
             else:
-                for el in connection.previous_elements:
-                    if (isinstance(el, element.Tag) == True):
-                        if el.get('framename') == source and source_chronotope is None:
-                            source_chronotope = el.get('type')
-                        elif el.get('framename') == target and target_chronotope is None:
-                            target_chronotope = el.get('type')
-
-            for el in connection.next_elements:
-                if (isinstance(el, element.Tag) == True and el.get('type') is not None):
-                    if el.get('framename') == target and target_chronotope is None:
-                        target_chronotope = el.get('type')
-                    elif el.get('framename') == source and source_chronotope is None:
-                        source_chronotope = el.get('type')
+                if target_chronotope is None:
+                    for chronotope in following(target, position):
+                        target_chronotope = chronotope
+                if source_chronotope is None:
+                    for chronotope in following(source, position):
+                        source_chronotope = chronotope
 
             if (source_chronotope != None and target_chronotope != None):
                 edges.append((source_chronotope, target_chronotope, relation))
@@ -642,13 +1018,13 @@ class DeepChronotopesGraphGenerator(GraphGenerator):
 
         # Then iterate over the topoi and calculate the number of characters in each, appending the values to the nodes
         chronotopes = {}
-        for topos in soup.find_all('topos'):
-            chronotope = topos.get('type')
+        for topos in topoi:
+            chronotope = topos['attrib'].get('type')
             try:
                 if chronotope not in chronotopes.keys():
-                    chronotopes[chronotope] = len(topos.get_text())
+                    chronotopes[chronotope] = topos['full_length']
                 else:
-                    chronotopes[chronotope] += len(topos.get_text())
+                    chronotopes[chronotope] += topos['full_length']
             except:
                 pass
 
@@ -657,79 +1033,381 @@ class DeepChronotopesGraphGenerator(GraphGenerator):
 
 
 class ArchetypesAndToporefsGraphGenerator(GraphGenerator):
+    # Each archetype and its toporefs tend to be an island of their own
+    pack_components = True
+    
     def generate(self):
         """
-        Takes an XML element marked up using the CC schema and returns a populated graph of the chronotope archteypes, 
+        Takes a document marked up using the CC schema and returns a populated graph of the chronotope archteypes, 
         their connections, and their associated toporefs.
         """
         
         self.output_suffix = self.output_root + '-topoi-and-chronotopic-archetypes'
         graph = self.graph
-        xml_element = self.xml_element
+        document = self.document
         
         topoi = {}
-        for topos in xml_element.iter('topos'):
+        for topos in document.topoi:
             try: 
-                chronotope = topos.attrib['type']
-                graph.nodes[chronotope]['length'] += len(''.join(topos.itertext()).strip())
+                chronotope = topos['attrib']['type']
+                graph.nodes[chronotope]['length'] += topos['length']
             except KeyError:
-                graph.add_node(topos.attrib['type'], length=len(''.join(topos.itertext()).strip()))
-            topoi[topos.attrib['framename']] = topos.attrib['type']
+                graph.add_node(topos['attrib']['type'], length=topos['length'])
+            topoi[topos['attrib']['framename']] = topos['attrib']['type']
 
-        for connection in xml_element.iter('connection'):
+        for connection in document.connections:
             try:
-                source_chronotope = topoi[connection.attrib['source']]
-                target_chronotope = topoi[connection.attrib['target']]
-                relation = connection.attrib['relation']
+                source_chronotope = topoi[connection['attrib']['source']]
+                target_chronotope = topoi[connection['attrib']['target']]
+                relation = connection['attrib']['relation']
                 graph.add_edge(source_chronotope, target_chronotope, relation=relation)
             except:
                 pass
 
-        for topos in xml_element.iter('topos'):
+        # Group the toporefs under every topos that contains them, including any enclosing topoi
+        contained_toporefs = [[] for topos in document.topoi]
+        for toporef in document.toporefs:
+            for i in toporef['topoi']:
+                contained_toporefs[i].append(toporef)
+
+        for topos, toporefs in zip(document.topoi, contained_toporefs):
             try:
-                chronotope = topos.attrib['type']
-                for toporef in topos.iter('toporef'):
-                    graph.add_edge(chronotope, '"' + toporef.text + '"', relation=toporef.attrib['relation'])
+                chronotope = topos['attrib']['type']
+                for toporef in toporefs:
+                    graph.add_edge(chronotope, '"' + toporef['text'] + '"', relation=toporef['attrib']['relation'])
             except:
                 pass
             
 
-def generate_all(xml_dir, output_dir, input_file):
+# The generators run for every file by generate_all and generate_corpus: complete, syuzhet, topoi, topoi and archetypes, deep chronotopes, and toporefs and archetypes.
+# The temporal topoi graphs are left out, and can be generated with TemporalTopoiGraphGenerator's generate and generate_simple.
+ALL_GENERATORS = [
+    CompleteGraphGenerator,
+    SyuzhetGraphGenerator,
+    TopoiGraphGenerator,
+    TopoiAndArchetypeGraphGenerator,
+    DeepChronotopesGraphGenerator,
+    ArchetypesAndToporefsGraphGenerator
+]
+
+
+def generate_all(xml_dir, output_dir, input_file, streaming=False, cache_dir='files/cache/', force=False, parallel=False):
     """
-    Generate ALL the graphs
+    Generate ALL the graphs. The XML is parsed once (or loaded from the cache), and the resulting document shared between the generators.
+    Graphs already written from the same XML are skipped, unless force is set. With parallel set, the chapters of the XML are parsed in separate processes.
     """
-    # Complete
-    complete = CompleteGraphGenerator(xml_dir=xml_dir, output_dir=output_dir, file=input_file)
-    complete.generate()
-    complete.write_gexf()
-    
-    # Syuzhet
-    syuzhet = SyuzhetGraphGenerator(xml_dir=xml_dir, output_dir=output_dir, file=input_file)
-    syuzhet.generate()
-    syuzhet.write_gexf()
-    
-    # Topoi
-    topoi = TopoiGraphGenerator(xml_dir=xml_dir, output_dir=output_dir, file=input_file)
-    topoi.generate()
-    topoi.write_gexf()
-    
-    # Time Topoi
-    #time_topoi = TemporalTopoiGraphGenerator(xml_dir=xml_dir, output_dir=output_dir, file=input_file)
-    #time_topoi.generate()
-    #time_topoi.write_gexf()
-    #time_topoi.generate_simple()
-    #time_topoi.write_gexf()
-    
-    # Topoi and Archetypes
-    topoi_and_archetypes = TopoiAndArchetypeGraphGenerator(xml_dir=xml_dir, output_dir=output_dir, file=input_file)
-    topoi_and_archetypes.generate()
-    topoi_and_archetypes.write_gexf()
-    
-    # Deep Chronotopes
-    deep_chronotopes = DeepChronotopesGraphGenerator(xml_dir=xml_dir, output_dir=output_dir, file=input_file)
-    deep_chronotopes.generate()
-    deep_chronotopes.write_gexf()
-    
-    toporefs_and_archetypes = ArchetypesAndToporefsGraphGenerator(xml_dir=xml_dir, output_dir=output_dir, file=input_file)
-    toporefs_and_archetypes.generate()
-    toporefs_and_archetypes.write_gexf()
\ No newline at end of file
+    document = load_document(input_file, xml_dir=xml_dir, cache_dir=cache_dir, streaming=streaming, parallel=parallel)
+    
+    for generator_class in ALL_GENERATORS:
+        generator = generator_class(xml_dir=xml_dir, output_dir=output_dir, file=input_file, document=document)
+        if not force and generator.is_current('gexf'):
+            continue
+        generator.generate()
+        generator.write_gexf()
+
+
+def generate_work(xml_files, output_root, output_dir='files/graphs/', cache_dir='files/cache/', index_file=None, force=False):
+    """
+    Generate ALL the graphs of a work coded as several XML files, eg. one per volume, as a single set of graphs named after output_root.
+    The volumes are merged into one document (see load_work), so connections between topoi in different volumes are kept. Volumes come from the cache where possible, and those that haven't changed since they were last indexed aren't even read to hash them.
+    Graphs already written from the same volumes are skipped, unless force is set.
+    
+    xml_files: a list of the work's files in order, or a directory or glob pattern matching them (taken in name order)
+    index_file: where the work's FramenameIndex is kept - defaults to .framenames.json beside the first file
+    """
+    paths = _xml_paths(xml_files)
+    work = _work_index(paths, index_file)
+    document = load_work(paths, cache_dir=cache_dir, work=work)
+    
+    for generator_class in ALL_GENERATORS:
+        generator = generator_class(file=None, output_dir=output_dir, output_root=output_root, document=document)
+        if not force and generator.is_current('gexf'):
+            continue
+        generator.generate()
+        generator.write_gexf()
+
+
+def _xml_paths(xml_files):
+    """The XML files in a list, a directory, or matching a glob pattern"""
+    if isinstance(xml_files, (list, tuple)):
+        return list(xml_files)
+    if os.path.isdir(xml_files):
+        return sorted(glob.glob(os.path.join(xml_files, '*.xml')))
+    return sorted(glob.glob(xml_files))
+
+
+def _work_index(paths, index_file=None):
+    """Loads the FramenameIndex of a multi-file work, brings it up to date with its files, and saves it if anything has changed"""
+    if index_file is None:
+        index_file = os.path.join(os.path.dirname(paths[0]) if len(paths) > 0 else '', '.framenames.json')
+    work = FramenameIndex(path=index_file)
+    if len(work.refresh(paths)) > 0:
+        work.save()
+    return work
+
+
+def _parse_for_corpus(path, cache_dir):
+    """Parse one file of a corpus into the cache, and report how it went. Runs in a worker process."""
+    start = time.perf_counter()
+    try:
+        document = load_document(path, cache_dir=cache_dir)
+        return {'status': 'ok', 'parse_seconds': time.perf_counter() - start, 'topoi': len(document.topoi), 'connections': len(document.connections), 'toporefs': len(document.toporefs)}
+    except Exception as e:
+        return {'status': 'error', 'parse_seconds': time.perf_counter() - start, 'error': ''.join(traceback.format_exception_only(type(e), e)).strip()}
+
+
+def _generate_for_corpus(generator_class, path, output_dir, cache_dir):
+    """Generate and write one graph for one file of a corpus, and report how it went. Runs in a worker process."""
+    start = time.perf_counter()
+    result = {'generator': generator_class.__name__}
+    try:
+        generator = generator_class(file=os.path.basename(path), xml_dir=os.path.dirname(path) + os.sep, output_dir=output_dir, cache_dir=cache_dir)
+        generator.generate()
+        result['nodes'] = generator.graph.number_of_nodes()
+        result['edges'] = generator.graph.number_of_edges()
+        result['output'] = output_dir + generator.output_root + generator.output_suffix + '.gexf'
+        generator.write_gexf()
+        result['status'] = 'ok'
+    except Exception as e:
+        result['status'] = 'error'
+        result['error'] = ''.join(traceback.format_exception_only(type(e), e)).strip()
+    result['seconds'] = time.perf_counter() - start
+    return result
+
+
+def generate_corpus(xml_files, output_dir='files/graphs/', processes=None, cache_dir='files/cache/', manifest_file='manifest.json', force=False):
+    """
+    Generate ALL the graphs for every XML file in a directory, or matching a glob pattern, using a pool of worker processes.
+    Each file is parsed once into the cache, then each of its graphs is generated as a separate task. A file that fails doesn't stop the rest of the batch.
+    Graphs already written from the same XML are skipped, unless force is set, so after editing one text only that text's graphs are rebuilt.
+    A manifest of every file's status, timings, node and edge counts and errors is written to output_dir and returned.
+    
+    processes: the number of worker processes - defaults to the number of CPUs
+    cache_dir: the parsed-document cache shared by the workers. With None, every graph task parses its file again.
+    """
+    if os.path.isdir(xml_files):
+        paths = sorted(glob.glob(os.path.join(xml_files, '*.xml')))
+    else:
+        paths = sorted(glob.glob(xml_files))
+    
+    start = time.perf_counter()
+    files = {path: {'file': path, 'graphs': []} for path in paths}
+    store = ArtifactStore(output_dir)
+    
+    # Work out which graphs of each file are out of date before doing anything else
+    stale = {}
+    for path in paths:
+        stale[path] = []
+        source_hash = None if force else file_hash(path)
+        for generator_class in ALL_GENERATORS:
+            key, inputs = generator_class.artifact(os.path.basename(path)[:-4], source_hash, 'gexf')
+            if force or not store.is_current(key, inputs):
+                stale[path].append(generator_class)
+            else:
+                files[path]['graphs'].append({'generator': generator_class.__name__, 'status': 'unchanged'})
+        if len(stale[path]) == 0:
+            files[path]['status'] = 'unchanged'
+    
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        # Parse every file first, and queue its graphs as soon as it's in the cache
+        parses = {pool.submit(_parse_for_corpus, path, cache_dir): path for path in paths if len(stale[path]) > 0}
+        graphs = {}
+        
+        for future in as_completed(parses):
+            path = parses[future]
+            try:
+                files[path].update(future.result())
+            except Exception as e:
+                files[path].update({'status': 'error', 'error': ''.join(traceback.format_exception_only(type(e), e)).strip()})
+            
+            if files[path]['status'] == 'ok':
+                for generator_class in stale[path]:
+                    graphs[pool.submit(_generate_for_corpus, generator_class, path, output_dir, cache_dir)] = (path, generator_class)
+        
+        for future in as_completed(graphs):
+            path, generator_class = graphs[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                result = {'generator': generator_class.__name__, 'status': 'error', 'error': ''.join(traceback.format_exception_only(type(e), e)).strip()}
+            files[path]['graphs'].append(result)
+            if result['status'] != 'ok':
+                files[path]['status'] = 'error'
+    
+    # Keep the graphs of each file in the same order as ALL_GENERATORS, whatever order they finished in
+    order = [generator_class.__name__ for generator_class in ALL_GENERATORS]
+    for entry in files.values():
+        entry['graphs'].sort(key=lambda result: order.index(result['generator']))
+    
+    manifest = {
+        'seconds': time.perf_counter() - start,
+        'files': [files[path] for path in paths],
+        'succeeded': len([path for path in paths if files[path]['status'] != 'error']),
+        'failed': len([path for path in paths if files[path]['status'] == 'error'])
+    }
+    
+    with open(output_dir + manifest_file, 'w') as f:
+        f.write(json.dumps(manifest, indent=4))
+    
+    return manifest
+
+
+def _validate_for_corpus(path, max_errors, work=None):
+    """
+    Validate one file of a corpus with the rules in validation.RULES, and return its findings. Runs in a worker process.
+    The file is read with iterparse, so reading stops as soon as max_errors errors have been found.
+    """
+    start = time.perf_counter()
+    sink = ListSink()
+    engine = RuleEngine(sinks=[sink], max_errors=max_errors, work=work, file=path)
+
+    try:
+        for event, el in etree.iterparse(path, events=('start', 'end')):
+            if event == 'start':
+                if el.tag in TAGS:
+                    engine.check(el.tag, el.attrib, el.sourceline)
+                    if engine.stopped:
+                        break
+            else:
+                el.clear(keep_tail=True)
+                parent = el.getparent()
+                while parent is not None and el.getprevious() is not None:
+                    del parent[0]
+    except Exception as e:
+        # The framenames are incomplete, so the cross-references can't be checked
+        engine.stopped = True
+        sink.write({
+            'type': 'error',
+            'category': 'syntax' if isinstance(e, etree.XMLSyntaxError) else 'parsing',
+            'line': getattr(e, 'lineno', 0),
+            'message': 'XML Syntax Error: ' + str(e) if isinstance(e, etree.XMLSyntaxError) else ''.join(traceback.format_exception_only(type(e), e)).strip(),
+            'rule': 'well-formed'
+        })
+
+    # The deferred rules can also take the file to max_errors, so whether it was stopped is only known once they have run
+    engine.finish()
+
+    return {
+        'file': path,
+        'findings': sink.findings,
+        'errors': len([f for f in sink.findings if f['type'] == 'error']),
+        'warnings': len([f for f in sink.findings if f['type'] == 'warning']),
+        'stopped': engine.stopped,
+        'seconds': time.perf_counter() - start
+    }
+
+
+def validate_corpus(xml_files, output='files/reports/validation.ndjson', processes=None, max_errors=None, work=None):
+    """
+    Validate every XML file in a list, a directory, or matching a glob pattern, using a pool of worker processes, then print a summary table.
+    One NDJSON record per finding (file, line, category, severity, rule and message, plus any suggestions) is written to output - a path or a file-like object - as each file finishes.
+    
+    processes: the number of worker processes - defaults to the number of CPUs
+    max_errors: stop checking a file once it has this many errors. Cross-references aren't checked in a file that has been stopped.
+    work: a FramenameIndex, so that connections can refer to topoi in the files it indexes - see validate_work
+    
+    Returns the summary of every file: its number of errors and warnings, whether it was stopped early, and how long it took.
+    """
+    paths = _xml_paths(xml_files)
+    
+    start = time.perf_counter()
+    summary = {}
+    
+    if isinstance(output, str):
+        os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    f = open(output, 'w') if isinstance(output, str) else output
+    try:
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            futures = {pool.submit(_validate_for_corpus, path, max_errors, work): path for path in paths}
+            for future in as_completed(futures):
+                path = futures[future]
+                try:
+                    result = future.result()
+                except Exception as e:
+                    result = {'file': path, 'findings': [], 'errors': 1, 'warnings': 0, 'stopped': True, 'seconds': 0.0, 'error': ''.join(traceback.format_exception_only(type(e), e)).strip()}
+                
+                for finding in result.pop('findings'):
+                    record = {
+                        'file': path,
+                        'line': finding.get('line', 0),
+                        'category': finding['category'],
+                        'severity': finding['type'],
+                        'rule': finding['rule'],
+                        'message': finding['message']
+                    }
+                    if 'suggestions' in finding:
+                        record['suggestions'] = finding['suggestions']
+                    f.write(json.dumps(record) + '\n')
+                f.flush()
+                summary[path] = result
+    finally:
+        if isinstance(output, str):
+            f.close()
+    
+    summary = [summary[path] for path in paths]
+    
+    table = '{:<50} {:>8} {:>8} {:>8} {:>8}\n'.format('File', 'Errors', 'Warnings', 'Stopped', 'Seconds')
+    for result in summary:
+        table += '{:<50} {:>8} {:>8} {:>8} {:>8.2f}\n'.format(os.path.basename(result['file'])[-50:], result['errors'], result['warnings'], 'yes' if result['stopped'] else '', result['seconds'])
+    table += '{:<50} {:>8} {:>8} {:>8} {:>8.2f}\n'.format(
+        str(len(summary)) + ' files (' + str(len([result for result in summary if result['errors'] > 0])) + ' with errors)',
+        sum(result['errors'] for result in summary), sum(result['warnings'] for result in summary), '', time.perf_counter() - start)
+    print(table)
+    
+    return summary
+
+
+def validate_work(xml_files, output='files/reports/validation.ndjson', processes=None, max_errors=None, index_file=None):
+    """
+    Validate the files of a work coded as several XML files, eg. one per volume, as one unit: connections in any file can refer to topoi in any other.
+    The framenames of every file are kept in a FramenameIndex saved at index_file (by default .framenames.json beside the first file), and only files that have changed since the last check are read again to update it.
+    To check a single volume against the rest of its work, pass the index to CCXMLValidator or validate_chapters instead.
+    xml_files is a list of files, a directory or a glob pattern. Otherwise as validate_corpus, whose summary is returned.
+    """
+    paths = _xml_paths(xml_files)
+    return validate_corpus(paths, output=output, processes=processes, max_errors=max_errors, work=_work_index(paths, index_file))
+
+
+def _validate_chapter(fragment, line_offset):
+    """
+    Check one fragment of a document from split_chapters with the non-deferred rules, and return its findings and the engine's partial results. Runs in a worker process.
+    Returns None if the fragment isn't well formed.
+    """
+    sink = ListSink()
+    engine = RuleEngine(sinks=[sink])
+    try:
+        root = etree.fromstring(fragment)
+    except etree.XMLSyntaxError:
+        return None
+    for el in root.iter(*TAGS):
+        engine.check(el.tag, el.attrib, el.sourceline + line_offset)
+    return sink.findings, engine.partial()
+
+
+def validate_chapters(file, *sinks, processes=None, max_errors=None, work=None):
+    """
+    Validate a very large document with the rules in validation.RULES, checking its chapters in parallel worker processes.
+    The document is split at its <chapter> start tags, as in CCDocument.from_chapters. Each chapter's elements are checked in a worker, and the framenames found by every worker are merged for a final pass over the cross-references.
+    Findings are reported to each sink in document order, printing them as text if no sinks are given. Returns the engine, whose stats are summed over the workers.
+    If the document can't be split at its chapters it's checked in a single pass instead.
+    work: a FramenameIndex of the multi-file work that the document is part of
+    """
+    engine = RuleEngine(sinks=sinks if len(sinks) > 0 else [TextSink()], max_errors=max_errors, work=work, file=file)
+    
+    with open(file, 'rb') as f:
+        data = f.read()
+    
+    fragments, line_offsets = split_chapters(data)
+    results = None
+    if len(fragments) >= 3:
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            results = list(pool.map(_validate_chapter, fragments, line_offsets))
+    
+    if results is None or None in results:
+        engine.validate(etree.parse(file).getroot())
+        return engine
+    
+    for findings, partial in results:
+        engine.merge(partial, findings)
+    engine.finish()
+    return engine
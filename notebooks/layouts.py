@@ -0,0 +1,525 @@
+# Python Core
+import math
+
+# Third party
+import numpy as np
+
+# Graph layouts written in NumPy, for graphs too large for networkx's own layouts, eg. the complete graph of a long novel with thousands of toporefs.
+# Each layout takes a networkx graph and returns {node: (x, y)}, centred on 0,0 and scaled so that no coordinate is further than scale from it, as networkx's layouts are - apart from warm_layout, which keeps the units of the positions it starts from.
+
+
+def node_sizes(graph, nodes, attribute='length'):
+    """
+    The relative size of each node, from its length: nodes are drawn with an area that grows with the length of text they cover, so size grows with its square root.
+    Sizes are scaled to average 1. Nodes without a length (eg. toporefs) are given the size of the shortest node that has one.
+    """
+    lengths = np.array([graph.nodes[node].get(attribute, np.nan) for node in nodes], dtype=float)
+    known = ~np.isnan(lengths)
+    if not known.any():
+        return np.ones(len(nodes))
+    lengths[~known] = lengths[known].min()
+    sizes = np.sqrt(1 + np.maximum(lengths, 0))
+    return sizes / sizes.mean()
+
+
+def edge_array(graph, index):
+    """The edges of a graph as an array of (source, target) node indices, without self loops"""
+    edges = np.array([(index[source], index[target]) for source, target in graph.edges() if source != target], dtype=np.int64)
+    return edges.reshape(-1, 2)
+
+
+def rescale(pos, scale=1):
+    """Centre positions on 0,0, and scale them so the furthest coordinate is scale from it"""
+    pos = pos - pos.mean(axis=0)
+    furthest = np.abs(pos).max()
+    if furthest > 0:
+        pos = pos * (scale / furthest)
+    return pos
+
+
+def ranges(starts, counts):
+    """The concatenation of range(start, start + count) for each start and count, eg. the neighbours of a set of nodes in a CSR adjacency list"""
+    return np.repeat(starts, counts) + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+
+
+def morton_codes(cells, depth):
+    """Interleave the bits of the x and y cell numbers of each point, so that the points in any quadtree cell have a run of consecutive codes"""
+    codes = np.zeros(len(cells), dtype=np.int64)
+    for bit in range(depth):
+        codes |= ((cells[:, 0] >> bit) & 1) << (2 * bit + 1)
+        codes |= ((cells[:, 1] >> bit) & 1) << (2 * bit)
+    return codes
+
+
+def repulsion(pos, mass, theta=1.0, depth=16):
+    """
+    The sum over every other node j of mass[j] * (pos[i] - pos[j]) / distance², for each node i, using the Barnes-Hut approximation.
+    The nodes are sorted into a quadtree, and a cell of the tree that is small compared to its distance from a node (cell width / distance < theta) is treated as a single mass at its centre.
+    Rather than visiting the tree node by node, the (node, cell) pairs still to be resolved are kept in arrays and refined a level at a time, so every level is a handful of NumPy operations over O(n) pairs.
+    Cells holding a single node are exact, and nodes still sharing a cell at the bottom of the tree are summed over directly.
+    """
+    n = len(pos)
+    force = np.zeros((n, 2))
+    if n < 2:
+        return force
+
+    lowest = pos.min(axis=0)
+    width = (pos.max(axis=0) - lowest).max()
+    if width == 0:
+        return force
+    width *= 1 + 1e-9
+
+    # Sort the nodes by their place along the tree, so that every cell at every level holds a run of consecutive nodes
+    cells = np.minimum(((pos - lowest) / width * (1 << depth)).astype(np.int64), (1 << depth) - 1)
+    codes = morton_codes(cells, depth)
+    order = np.argsort(codes, kind='stable')
+    codes = codes[order]
+    pos = pos[order]
+    mass = mass[order]
+    weighted = pos * mass[:, None]
+    sorted_force = np.zeros((n, 2))
+
+    def level_cells(level):
+        """The first node of each non-empty cell at a level, the cell each node is in, and each cell's code, number of nodes, mass and centre of mass"""
+        shifted = codes >> (2 * (depth - level))
+        new_cell = np.concatenate([[True], shifted[1:] != shifted[:-1]])
+        starts = np.flatnonzero(new_cell)
+        cell_mass = np.add.reduceat(mass, starts)
+        centre = np.add.reduceat(weighted, starts, axis=0) / cell_mass[:, None]
+        return starts, np.cumsum(new_cell) - 1, shifted[starts], np.diff(np.append(starts, n)), cell_mass, centre
+
+    def push(nodes, delta, weight):
+        # Nodes in exactly the same place push each other apart a little, in a direction fixed by their index, rather than not at all
+        distance2 = (delta ** 2).sum(axis=1)
+        stuck = distance2 == 0
+        if stuck.any():
+            angle = nodes[stuck] * 2.399963
+            delta[stuck] = np.stack([np.cos(angle), np.sin(angle)], axis=1) * width * 1e-9
+            distance2[stuck] = (width * 1e-9) ** 2
+        scale = weight / distance2
+        sorted_force[:, 0] += np.bincount(nodes, weights=delta[:, 0] * scale, minlength=n)
+        sorted_force[:, 1] += np.bincount(nodes, weights=delta[:, 1] * scale, minlength=n)
+
+    # Start with every node paired with the root cell
+    current = level_cells(0)
+    nodes = np.arange(n)
+    pairs = np.zeros(n, dtype=np.int64)
+
+    for level in range(1, depth + 1):
+        # Pair each node with every child of the cells it was paired with
+        child = level_cells(level)
+        first = np.searchsorted(child[2], current[2][pairs] << 2)
+        counts = np.searchsorted(child[2], (current[2][pairs] << 2) + 4) - first
+        nodes = np.repeat(nodes, counts)
+        pairs = ranges(first, counts)
+        current = child
+
+        starts, inside, level_codes, count, cell_mass, centre = current
+        cell_width = width / (1 << level)
+        own = inside[nodes] == pairs
+        delta = pos[nodes] - centre[pairs]
+        single = count[pairs] == 1
+        accept = ~own & (single | (cell_width * cell_width < theta * theta * (delta ** 2).sum(axis=1)))
+        push(nodes[accept], delta[accept], cell_mass[pairs[accept]])
+
+        # A node's own cell, once it's the only node in it, has nothing left to push it
+        keep = ~accept & ~(own & single)
+        nodes = nodes[keep]
+        pairs = pairs[keep]
+        if len(nodes) == 0:
+            break
+
+    if len(nodes) > 0:
+        # The nodes left share a cell at the bottom of the tree with others, or are very close to one: sum over the nodes of those cells directly
+        starts, inside, level_codes, count, cell_mass, centre = current
+        counts = count[pairs]
+        others = ranges(starts[pairs], counts)
+        nodes = np.repeat(nodes, counts)
+        keep = others != nodes
+        push(nodes[keep], pos[nodes[keep]] - pos[others[keep]], mass[others[keep]])
+
+    force[order] = sorted_force
+    return force
+
+
+def barnes_hut_layout(graph, scale=1, iterations=100, theta=1.0, gravity=1.0, seed=None, size_attribute='length'):
+    """
+    A force-directed layout in the manner of Fruchterman and Reingold: edges pull their nodes together, every node pushes every other away, and nodes move less as the layout cools.
+    The repulsion between every pair of nodes is approximated with a quadtree (see repulsion), so each iteration takes O(n log n) time rather than O(n²).
+    Larger nodes (by size_attribute) push harder, and edges only pull once their nodes are clear of each other, so large topoi get the room they need.
+    gravity pulls everything gently towards the centre, so that separate components don't drift apart.
+    """
+    nodes = list(graph.nodes())
+    n = len(nodes)
+    if n == 0:
+        return {}
+    if n == 1:
+        return {nodes[0]: (0.0, 0.0)}
+
+    index = {node: i for i, node in enumerate(nodes)}
+    edges = edge_array(graph, index)
+    mass = node_sizes(graph, nodes, size_attribute)
+
+    # The ideal distance between nodes, for n nodes spread over a unit square, and the room each node needs
+    k = 1 / math.sqrt(n)
+    radius = 0.25 * k * mass
+
+    pos = np.random.RandomState(seed).rand(n, 2)
+    temperature = 0.1
+    cooling = temperature / (iterations + 1)
+
+    for i in range(iterations):
+        displacement = k * k * repulsion(pos, mass, theta)
+
+        if len(edges) > 0:
+            delta = pos[edges[:, 0]] - pos[edges[:, 1]]
+            distance = np.maximum(np.sqrt((delta ** 2).sum(axis=1)), 1e-9)
+            pull = (np.maximum(distance - radius[edges[:, 0]] - radius[edges[:, 1]], 0) ** 2 / k / distance)[:, None] * delta
+            displacement[:, 0] -= np.bincount(edges[:, 0], weights=pull[:, 0], minlength=n) - np.bincount(edges[:, 1], weights=pull[:, 0], minlength=n)
+            displacement[:, 1] -= np.bincount(edges[:, 0], weights=pull[:, 1], minlength=n) - np.bincount(edges[:, 1], weights=pull[:, 1], minlength=n)
+
+        displacement -= gravity * k * mass[:, None] * (pos - pos.mean(axis=0))
+
+        # Move each node along its displacement, by no more than the temperature
+        length = np.maximum(np.sqrt((displacement ** 2).sum(axis=1)), 1e-9)
+        pos += displacement * (np.minimum(length, temperature) / length)[:, None]
+        temperature -= cooling
+
+    pos = rescale(pos, scale)
+    return {node: (pos[i, 0], pos[i, 1]) for i, node in enumerate(nodes)}
+
+
+def adjacency(n, edges):
+    """The undirected adjacency lists of a graph in CSR form: the neighbours of node i are indices[indptr[i]:indptr[i + 1]]"""
+    sources = np.concatenate([edges[:, 0], edges[:, 1]])
+    targets = np.concatenate([edges[:, 1], edges[:, 0]])
+    order = np.argsort(sources, kind='stable')
+    indptr = np.concatenate([[0], np.cumsum(np.bincount(sources, minlength=n))])
+    return indptr, targets[order]
+
+
+def bfs_distances(indptr, indices, source):
+    """The number of edges from source to every node, found a level at a time. Nodes that can't be reached from source are -1."""
+    distance = np.full(len(indptr) - 1, -1, dtype=np.int64)
+    distance[source] = 0
+    frontier = np.array([source])
+    level = 0
+    while len(frontier) > 0:
+        level += 1
+        neighbours = indices[ranges(indptr[frontier], indptr[frontier + 1] - indptr[frontier])]
+        frontier = np.unique(neighbours[distance[neighbours] < 0])
+        distance[frontier] = level
+    return distance
+
+
+def component_labels(n, edges):
+    """A label for each node's connected component, the lowest index among its nodes, found by passing the lowest label along the edges until none changes"""
+    label = np.arange(n)
+    while len(edges) > 0:
+        new = label.copy()
+        np.minimum.at(new, edges[:, 0], label[edges[:, 1]])
+        np.minimum.at(new, edges[:, 1], label[edges[:, 0]])
+        # A node's label is another node in its component, so following labels to theirs passes the lowest along faster
+        new = new[new]
+        if (new == label).all():
+            break
+        label = new
+    return label
+
+
+def local_terms(indptr, indices, edges, siblings=3):
+    """
+    The terms of a sparse stress between nearby nodes, as arrays of (node, other node, distance, weight): each edge both ways, at a distance of 1, and a few pairs of nodes with a neighbour in common (siblings per neighbour), at a distance of 2.
+    Nodes that share a neighbour are two steps apart. Without a term for that, the leaves of a hub all fall on the same spot, so each node is kept two steps from the next few neighbours of each of its neighbours.
+    """
+    degree = np.diff(indptr)
+    entry_degree = np.repeat(degree, degree)
+    entry_place = np.arange(len(indices)) - np.repeat(indptr[:-1], degree)
+    sibling_node = [np.zeros(0, dtype=np.int64)]
+    sibling_other = [np.zeros(0, dtype=np.int64)]
+    for offset in range(1, siblings + 1):
+        entries = np.flatnonzero(entry_degree > offset)
+        partners = indptr[:-1].repeat(degree)[entries] + (entry_place[entries] + offset) % entry_degree[entries]
+        sibling_node.append(indices[entries])
+        sibling_other.append(indices[partners])
+    sibling_node = np.concatenate(sibling_node)
+    sibling_other = np.concatenate(sibling_other)
+
+    term_node = np.concatenate([edges[:, 0], edges[:, 1], sibling_node, sibling_other])
+    term_other = np.concatenate([edges[:, 1], edges[:, 0], sibling_other, sibling_node])
+    term_distance = np.concatenate([np.ones(2 * len(edges)), np.full(2 * len(sibling_node), 2.0)])
+    term_weight = 1 / term_distance ** 2
+    keep = term_node != term_other
+    return term_node[keep], term_other[keep], term_distance[keep], term_weight[keep]
+
+
+def pull_to_targets(pos, term_node, term_other, term_distance, term_weight):
+    """For each node, the weighted sum of where each of its terms would put it: term_distance from the other node, in the direction it is now"""
+    delta = pos[term_node] - pos[term_other]
+    length = np.maximum(np.sqrt((delta ** 2).sum(axis=1)), 1e-9)
+    target = pos[term_other] + delta * (term_distance / length)[:, None]
+    return np.stack([
+        np.bincount(term_node, weights=term_weight * target[:, 0], minlength=len(pos)),
+        np.bincount(term_node, weights=term_weight * target[:, 1], minlength=len(pos))
+    ], axis=1).astype(float)
+
+
+def stress_layout(graph, scale=1, pivots=50, siblings=3, iterations=30, tolerance=1e-4):
+    """
+    A layout that places nodes so that the distance between them matches the number of edges between them, as Kamada-Kawai's does, but that scales to graphs with tens of thousands of nodes.
+    It follows Ortmann, Klimenta and Brandes' sparse stress model. Rather than every pair of nodes, only a few pivot nodes are measured from, with a breadth-first search each:
+    - The pivots' distances give a starting layout by pivot MDS (Brandes and Pich), in O(pivots * n) time.
+    - The layout is then refined by stress majorisation over just the graph's edges, a few pairs of nodes with a neighbour in common (siblings per neighbour), and each node's distance to every pivot. A pivot stands for the nodes closest to it, so its pull is weighted by how many of them it stands for.
+    Nodes in separate components are kept a step further apart than the furthest nodes of any one component. Once every pivot has been used, components that no pivot reaches (eg. the last of many isolated nodes) are started on a ring around the rest, a node to each place, and held there only by their own edges.
+    The layout doesn't depend on a random seed.
+    """
+    nodes = list(graph.nodes())
+    n = len(nodes)
+    if n == 0:
+        return {}
+    if n == 1:
+        return {nodes[0]: (0.0, 0.0)}
+
+    index = {node: i for i, node in enumerate(nodes)}
+    edges = edge_array(graph, index)
+    indptr, indices = adjacency(n, edges)
+
+    # Choose pivots that are spread over the graph: each is the node furthest from the pivots chosen so far, starting from the best connected node
+    pivots = min(pivots, n)
+    chosen = [int(np.argmax(np.diff(indptr)))]
+    distances = np.zeros((pivots, n))
+    nearest = np.full(n, np.inf)
+    for p in range(pivots):
+        distance = bfs_distances(indptr, indices, chosen[p]).astype(float)
+        distance[distance < 0] = np.inf
+        distances[p] = distance
+        nearest = np.minimum(nearest, distance)
+        if p + 1 < pivots:
+            # Unreachable nodes are furthest of all, so every component gets a pivot
+            chosen.append(int(np.argmax(np.where(np.isin(np.arange(n), chosen), -1, nearest))))
+    stranded = np.isinf(nearest)
+    unreachable = np.isinf(distances)
+    if unreachable.any():
+        distances[unreachable] = distances[~unreachable].max() + 1
+
+    # Pivot MDS: double-centre the squared distances, and take the two strongest directions
+    squared = distances.T ** 2
+    centred = squared - squared.mean(axis=0) - squared.mean(axis=1)[:, None] + squared.mean()
+    centred *= -0.5
+    values, vectors = np.linalg.eigh(centred.T @ centred)
+    pos = centred @ vectors[:, [-1, -2]]
+    if pos.std() == 0:
+        pos = np.random.RandomState(0).rand(n, 2)
+
+    # The terms of the sparse stress. Edges pull both ways, with a weight of 1. Each node is also pulled towards each pivot, standing in for the nodes of the pivot's region (those closest to it) that are no more than half as far from the pivot as the node is.
+    region = np.argmin(distances, axis=0)
+    represented = np.zeros((pivots, n))
+    for p in range(pivots):
+        members = np.sort(distances[p, region == p])
+        represented[p] = np.searchsorted(members, distances[p] / 2, side='right')
+    pivot_weight = np.maximum(represented, 1) / np.maximum(distances, 1) ** 2
+    pivot_weight[distances == 0] = 0
+    # Every pivot is the same distance from a stranded node, so those terms would pull all stranded nodes to the same spot
+    pivot_weight[:, stranded] = 0
+    pivot_index = np.array(chosen)
+
+    # Scale the MDS layout so that it has the least stress over the pivot terms, or the first steps can overshoot and pull nodes together
+    length = np.sqrt(((pos[None, :, :] - pos[pivot_index][:, None, :]) ** 2).sum(axis=2))
+    pos *= (pivot_weight * distances * length).sum() / max((pivot_weight * length ** 2).sum(), 1e-12)
+
+    # Stranded nodes go on a ring a step outside the rest, a step apart, with the nodes of each component next to each other
+    if stranded.any():
+        ring = np.flatnonzero(stranded)
+        labels = component_labels(n, edges[stranded[edges[:, 0]]])
+        ring = ring[np.lexsort((ring, labels[ring]))]
+        centre = pos[~stranded].mean(axis=0)
+        radius = max(np.sqrt(((pos[~stranded] - centre) ** 2).sum(axis=1)).max() + 1, len(ring) / (2 * math.pi))
+        angle = 2 * math.pi * np.arange(len(ring)) / len(ring)
+        pos[ring] = centre + radius * np.stack([np.cos(angle), np.sin(angle)], axis=1)
+
+    term_node, term_other, term_distance, term_weight = local_terms(indptr, indices, edges, siblings)
+    total_weight = np.bincount(term_node, weights=term_weight, minlength=n) + pivot_weight.sum(axis=0)
+    # Nodes without any terms, ie. stranded isolated nodes, stay where they start
+    still = total_weight == 0
+    total_weight[still] = 1
+
+    # Stress majorisation: move every node to the weighted average of where each of its terms would put it
+    for i in range(iterations):
+        new_pos = pull_to_targets(pos, term_node, term_other, term_distance, term_weight)
+
+        # The pivot terms make a dense pivots x n block, so they're summed as one
+        pivot_pos = pos[pivot_index][:, None, :]
+        delta = pos[None, :, :] - pivot_pos
+        length = np.maximum(np.sqrt((delta ** 2).sum(axis=2)), 1e-9)
+        new_pos += (pivot_weight[:, :, None] * (pivot_pos + delta * (distances / length)[:, :, None])).sum(axis=0)
+
+        new_pos /= total_weight[:, None]
+        new_pos[still] = pos[still]
+        movement = np.abs(new_pos - pos).max()
+        pos = new_pos
+        if movement < tolerance * max(np.abs(pos).max(), 1):
+            break
+
+    pos = rescale(pos, scale)
+    return {node: (pos[i, 0], pos[i, 1]) for i, node in enumerate(nodes)}
+
+
+def warm_layout(graph, known, iterations=10, pin=True, anchor=4.0, siblings=3, seed=None):
+    """
+    Lay out a graph starting from the positions of some of its nodes, eg. a layout that has been adjusted by hand since, so that when a few nodes or edges are added the rest of the graph stays where it was.
+    known: {node: (x, y)}. Positions of nodes that aren't in the graph are ignored.
+    - New nodes start at the average position of their neighbours that have been placed, a ring of neighbours at a time, nudged apart at random. A component with no known nodes at all is started beside the layout.
+    - A few rounds of stress majorisation over the edges and sibling pairs (see local_terms) then settle the new nodes, with an edge as long as the known nodes' typical edge.
+    - If pin is set, known nodes don't move. Otherwise they're held near where they were, by a pull anchor times as strong as all their terms together.
+    Unlike the other layouts, positions are in the units of known, and aren't rescaled. If no node's position is known, the graph is laid out afresh by stress_layout.
+    """
+    nodes = list(graph.nodes())
+    n = len(nodes)
+    origin = np.array([known.get(node, (np.nan, np.nan)) for node in nodes], dtype=float).reshape(-1, 2)
+    is_known = ~np.isnan(origin).any(axis=1)
+    if not is_known.any():
+        return stress_layout(graph)
+
+    index = {node: i for i, node in enumerate(nodes)}
+    edges = edge_array(graph, index)
+    indptr, indices = adjacency(n, edges)
+    sources = np.repeat(np.arange(n), np.diff(indptr))
+    random = np.random.RandomState(seed)
+
+    # The length of an edge: the median over edges between known nodes, or if there are none, the spacing of the known nodes were they spread evenly
+    both_known = is_known[edges[:, 0]] & is_known[edges[:, 1]]
+    if both_known.any():
+        unit = np.median(np.sqrt(((origin[edges[both_known, 0]] - origin[edges[both_known, 1]]) ** 2).sum(axis=1)))
+    else:
+        extent = origin[is_known].max(axis=0) - origin[is_known].min(axis=0)
+        unit = np.sqrt(extent[0] * extent[1] / is_known.sum())
+    if not unit > 0:
+        unit = 1.0
+
+    # Place new nodes a ring at a time, each at the average of its placed neighbours
+    pos = np.where(is_known[:, None], origin, 0)
+    placed = is_known.copy()
+    beside = np.array([origin[is_known, 0].max() + 2 * unit, origin[is_known, 1].min()])
+    while not placed.all():
+        ring = (~placed[sources]) & placed[indices]
+        if not ring.any():
+            # The rest of the new nodes aren't connected to any placed node, so one of them starts a fresh component beside the layout
+            first = np.flatnonzero(~placed)[0]
+            pos[first] = beside
+            placed[first] = True
+            beside = beside + [0, 2 * unit]
+            continue
+        count = np.bincount(sources[ring], minlength=n)
+        new = count > 0
+        pos[new, 0] = np.bincount(sources[ring], weights=pos[indices[ring], 0], minlength=n)[new] / count[new]
+        pos[new, 1] = np.bincount(sources[ring], weights=pos[indices[ring], 1], minlength=n)[new] / count[new]
+        pos[new] += random.normal(scale=0.5 * unit, size=(new.sum(), 2))
+        placed |= new
+
+    # Settle the new nodes, in units of edges
+    pos /= unit
+    home = origin / unit
+    term_node, term_other, term_distance, term_weight = local_terms(indptr, indices, edges, siblings)
+    total_weight = np.bincount(term_node, weights=term_weight, minlength=n)
+    anchor_weight = np.where(is_known, anchor * np.maximum(total_weight, 1), 0)
+    if not pin:
+        total_weight += anchor_weight
+    alone = total_weight == 0
+    total_weight[alone] = 1
+    for i in range(iterations):
+        new_pos = pull_to_targets(pos, term_node, term_other, term_distance, term_weight)
+        if not pin:
+            new_pos[is_known] += anchor_weight[is_known, None] * home[is_known]
+        new_pos /= total_weight[:, None]
+        new_pos[alone] = pos[alone]
+        if pin:
+            new_pos[is_known] = home[is_known]
+        pos = new_pos
+
+    pos *= unit
+    if pin:
+        pos[is_known] = origin[is_known]
+    return {node: (pos[i, 0], pos[i, 1]) for i, node in enumerate(nodes)}
+
+
+def pack(sizes, gap=1.0):
+    """
+    Packs rectangles of the given (width, height) sizes into a roughly square area, and returns the position of each one's lower left corner.
+    Rectangles go onto shelves tallest first, and a shelf is full once it's as wide as the square root of their total area. The end of each shelf is found with a binary search over the running total of widths, so a loop runs once per shelf rather than once per rectangle.
+    gap is left between neighbouring rectangles.
+    """
+    sizes = np.asarray(sizes, dtype=float).reshape(-1, 2) + gap
+    order = np.argsort(-sizes[:, 1], kind='stable')
+    widths = sizes[order, 0]
+    ends = np.cumsum(widths)
+    shelf_width = max(np.sqrt((sizes[:, 0] * sizes[:, 1]).sum()), widths.max() if len(widths) > 0 else 0)
+
+    corners = np.zeros((len(sizes), 2))
+    start = 0
+    y = 0.0
+    while start < len(order):
+        before = ends[start - 1] if start > 0 else 0.0
+        end = max(int(np.searchsorted(ends, before + shelf_width, side='right')), start + 1)
+        shelf = order[start:end]
+        corners[shelf, 0] = ends[start:end] - widths[start:end] - before
+        corners[shelf, 1] = y
+        y += sizes[shelf[0], 1]
+        start = end
+    return corners
+
+
+def timeline_layout(graph, first, lane, scale=1, sweeps=4):
+    """
+    Lays a graph out as a timeline: each node's x is the order in which it first appears (first, {node: index}), and its y is a lane for its kind (lane, {node: name}, eg. its chronotope), so the same graph always has the same layout.
+    Lanes start in the order their first nodes appear. Then, to cut down edges crossing lanes on their way between others, a few sweeps of the barycentre heuristic move each lane towards the lanes it has edges to, keeping whichever order makes the edges span fewest lanes. Within its lane, each node is nudged towards the side its neighbours are on.
+    Every step is a handful of NumPy operations over the nodes or edges, so the layout takes O(n log n) time for n nodes, for the sort by first appearance. The other sorts are of the lanes, of which there are only a few.
+    x is scaled to run from -scale to scale, and y to fit within half of that.
+    """
+    nodes = list(graph.nodes())
+    n = len(nodes)
+    if n == 0:
+        return {}
+
+    index = {node: i for i, node in enumerate(nodes)}
+    edges = edge_array(graph, index)
+
+    # Rank the nodes by first appearance, breaking ties by the order they were added in
+    order = np.argsort(np.array([first[node] for node in nodes], dtype=float), kind='stable')
+    x = np.empty(n)
+    x[order] = np.arange(n)
+
+    # Number the lanes in order of their first node
+    names = {}
+    for i in order:
+        names.setdefault(lane[nodes[i]], len(names))
+    node_lane = np.array([names[lane[node]] for node in nodes], dtype=np.int64)
+    lanes = len(names)
+
+    # Barycentre sweeps over the lanes, weighted by the edges between each pair
+    between = edges[node_lane[edges[:, 0]] != node_lane[edges[:, 1]]]
+    ends = np.concatenate([node_lane[between], node_lane[between][:, ::-1]])
+    lane_y = np.arange(lanes, dtype=float)
+    span = np.abs(lane_y[ends[:, 0]] - lane_y[ends[:, 1]]).sum()
+    for i in range(sweeps):
+        count = np.bincount(ends[:, 0], minlength=lanes)
+        barycentre = np.where(count > 0, np.bincount(ends[:, 0], weights=lane_y[ends[:, 1]], minlength=lanes) / np.maximum(count, 1), lane_y)
+        new_y = np.empty(lanes)
+        new_y[np.argsort(barycentre, kind='stable')] = np.arange(lanes)
+        new_span = np.abs(new_y[ends[:, 0]] - new_y[ends[:, 1]]).sum()
+        if new_span >= span:
+            break
+        lane_y, span = new_y, new_span
+
+    # Nudge each node up to a third of a lane towards its neighbours
+    y = lane_y[node_lane]
+    if len(edges) > 0:
+        sources = np.concatenate([edges[:, 0], edges[:, 1]])
+        targets = np.concatenate([edges[:, 1], edges[:, 0]])
+        count = np.bincount(sources, minlength=n)
+        neighbour_y = np.bincount(sources, weights=y[targets], minlength=n) / np.maximum(count, 1)
+        y = y + np.where(count > 0, np.clip(neighbour_y - y, -1, 1) / 3, 0)
+
+    pos = np.stack([x - x.mean(), y - y.mean()], axis=1)
+    pos[:, 0] *= scale / max(np.abs(pos[:, 0]).max(), 1e-9)
+    pos[:, 1] *= scale / 2 / max(np.abs(pos[:, 1]).max(), 1e-9)
+    return {node: (pos[i, 0], pos[i, 1]) for i, node in enumerate(nodes)}
@@ -0,0 +1,732 @@
+# Python Core
+from collections import Counter
+from difflib import SequenceMatcher
+from lxml import etree
+import hashlib
+import heapq
+import json
+import os
+import pprint
+import sys
+import time
+
+# A rule engine for checking Chrono-carto encoded XML. The same module is used by the notebooks and by the Flask app, so that both report the same problems.
+
+# Valid chronotope types
+chronotopes = [
+    'anti-idyll', 'castle', 'distortion', 'encounter',
+    'idyll', 'metanarrative', 'parlour', 'public square',
+    'road', 'threshold', 'provincial town', 'wilderness'
+]
+
+# Valid connection relations
+connections = [
+    'direct', 'indirect', 'interrupt', 'jump',
+    'charshift', 'projection', 'metatextual',
+    'paratextual', 'intratextual', 'metaphor'
+]
+
+# Sets of the above, for the checks. The lists are kept for the messages, so that valid types are listed in a consistent order.
+chronotope_set = set(chronotopes)
+connection_set = set(connections)
+
+# The elements that rules can check
+TAGS = ('topos', 'connection', 'toporef')
+
+
+def trigrams(name):
+    """The set of three-letter sequences in a name, padded so that its start and end count for more"""
+    padded = '  ' + name.lower() + ' '
+    return set(padded[i:i + 3] for i in range(len(padded) - 2))
+
+
+class SuggestionIndex:
+    """
+    A multiset of names, eg. framenames, with an index of their trigrams for suggesting the names closest to one that doesn't match.
+    Names can be added and removed as a document is read or edited. Suggesting only ever looks at a few hundred names, gathered from the misspelt name's rarest trigrams, so it stays quick however many names there are.
+    """
+
+    # Name -> the number of times it has been added
+    counts = None
+
+    # Trigram -> the names containing it
+    postings = None
+
+    # (word, limit, cutoff) -> the names suggested for it, until a name is added or removed
+    suggested = None
+
+    def __init__(self, names=()):
+        self.counts = {}
+        self.postings = {}
+        self.suggested = {}
+        for name in names:
+            self.add(name)
+
+    def __contains__(self, name):
+        return name in self.counts
+
+    def __len__(self):
+        return len(self.counts)
+
+    def __iter__(self):
+        return iter(self.counts)
+
+    def add(self, name, count=1):
+        if name not in self.counts:
+            self.counts[name] = 0
+            for gram in trigrams(name):
+                self.postings.setdefault(gram, set()).add(name)
+            self.suggested = {}
+        self.counts[name] += count
+
+    def remove(self, name):
+        self.counts[name] -= 1
+        if self.counts[name] == 0:
+            del self.counts[name]
+            for gram in trigrams(name):
+                self.postings[gram].discard(name)
+            self.suggested = {}
+
+    def update(self, counts):
+        """Add the names of a dict of name -> count, eg. the counts of another index"""
+        for name, count in counts.items():
+            self.add(name, count)
+
+    def rarest(self, word, missing=1 / 3):
+        """The trigrams of word whose posting lists suggest reads, rarest first: one more than the number a candidate can be missing"""
+        grams = trigrams(word)
+        found = sorted((gram for gram in grams if len(self.postings.get(gram, ())) > 0), key=lambda gram: len(self.postings[gram]))
+        # Trigrams that no name has are missing from every candidate already
+        return found[:max(int(len(grams) * missing) - (len(grams) - len(found)) + 1, 1)]
+
+    def suggest(self, word, limit=3, cutoff=0.6, candidates=10, missing=1 / 3, gather=1000):
+        """
+        The names most similar to word, best first, as ranked by difflib. However many names there are, only a few hundred are usually looked at.
+        Only names that have all but a fraction (missing) of word's trigrams are candidates. Such a name has to be in at least one of the posting lists of word's rarest trigrams - one more than the number it can be missing - so only those lists are read. A common trigram, eg. of 'the ', is in most names, and its list is rarely needed.
+        No more than about gather names are read, even when every trigram is common. The candidates in the most of those lists, and closest to word's length, are then ranked by difflib.
+        Suggestions are remembered, as a misspelt name is often used many times.
+        """
+        key = (word, limit, cutoff)
+        if key in self.suggested:
+            return list(self.suggested[key])
+
+        rarest = [self.postings[gram] for gram in self.rarest(word, missing)]
+        shared = Counter()
+        for posting in rarest:
+            if len(shared) + len(posting) > gather:
+                if len(shared) == 0:
+                    # Even the rarest list is too long to read in full, so only the names in the most of the rare lists, and closest to word's length, are kept from it
+                    overlap = {name: sum(name in other for other in rarest) for name in posting}
+                    shared.update({name: overlap[name] for name in heapq.nlargest(gather, posting, key=lambda name: (overlap[name], -abs(len(name) - len(word)), name))})
+                break
+            shared.update(posting)
+
+        # Rank the candidates by how many of the rare trigrams they have, then by how close they are to word's length
+        similarity = {name: (count, -abs(len(name) - len(word))) for name, count in shared.items()}
+        suggestions = closest(word, heapq.nlargest(candidates, similarity, key=lambda name: (similarity[name], name)), limit, cutoff)
+        self.suggested[key] = suggestions
+        return list(suggestions)
+
+
+def closest(word, names, limit=3, cutoff=0.6):
+    """The names most similar to word, best first, as ranked by difflib"""
+    # As in difflib.get_close_matches, the word is the second sequence, which SequenceMatcher indexes once
+    matcher = SequenceMatcher()
+    matcher.set_seq2(word.lower())
+
+    # The ratio can't be higher than the quick upper bounds, so names are compared in full best bound first, until no other name could make the top limit
+    bounded = []
+    for name in set(names):
+        matcher.set_seq1(name.lower())
+        if matcher.real_quick_ratio() >= cutoff:
+            bound = matcher.quick_ratio()
+            if bound >= cutoff:
+                bounded.append((-bound, name))
+    bounded.sort()
+
+    scored = []
+    for bound, name in bounded:
+        if len(scored) >= limit and -bound < -scored[limit - 1][0]:
+            break
+        matcher.set_seq1(name.lower())
+        ratio = matcher.ratio()
+        if ratio >= cutoff:
+            scored.append((-ratio, name))
+            scored.sort()
+    return [name for ratio, name in scored[:limit]]
+
+
+chronotope_index = SuggestionIndex(chronotopes)
+connection_index = SuggestionIndex(connections)
+
+
+def did_you_mean(text, suggestions):
+    """Returns the text of a finding with its suggestions, for rules that make suggestions"""
+    if len(suggestions) > 0:
+        text += '. Did you mean ' + ' or '.join('"' + name + '"' for name in suggestions) + '?'
+    return text, suggestions
+
+
+def read_framenames(file, chunk_size=1024 * 1024):
+    """
+    Reads the topos framenames of an XML file, counting the topoi with each, in a single streaming pass that also hashes the file.
+    Returns (framenames, hash, error), where error is the text of a syntax error, or None. The framenames read before a syntax error are kept.
+    """
+    framenames = {}
+    digest = hashlib.sha256()
+    parser = etree.XMLPullParser(events=('start', 'end'))
+    error = None
+
+    def read_events():
+        for event, el in parser.read_events():
+            if event == 'start':
+                if el.tag == 'topos' and 'framename' in el.attrib:
+                    framenames[el.get('framename')] = framenames.get(el.get('framename'), 0) + 1
+            else:
+                el.clear(keep_tail=True)
+                parent = el.getparent()
+                while parent is not None and el.getprevious() is not None:
+                    del parent[0]
+
+    with open(file, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+            if error is None:
+                try:
+                    parser.feed(chunk)
+                    read_events()
+                except etree.XMLSyntaxError as e:
+                    error = str(e)
+    if error is None:
+        try:
+            parser.close()
+            read_events()
+        except etree.XMLSyntaxError as e:
+            error = str(e)
+
+    return framenames, digest.hexdigest(), error
+
+
+class FramenameIndex:
+    """
+    The topos framenames of every file of a multi-file work, eg. its volumes, so that a connection in one file can refer to a topos in another.
+    The index can be saved as JSON. Files are only read again when their size or modification time has changed, so checking one volume doesn't mean parsing the rest.
+    Looking up a framename is a dict lookup, however many files there are.
+    """
+
+    # Where the index is saved, or None
+    path = None
+
+    # Absolute path -> {'size', 'mtime', 'hash', 'framenames', 'error'}, where framenames counts the file's topoi with each framename
+    files = None
+
+    # Framename -> {path: count} for the files it appears in
+    owners = None
+
+    # Every framename, for suggestions
+    names = None
+
+    def __init__(self, files=(), path=None):
+        """Loads the index saved at path, if there is one, then brings it up to date with files"""
+        self.path = path
+        self.files = {}
+        self.owners = {}
+        self.names = SuggestionIndex()
+
+        # A missing or unreadable index is built again from scratch
+        saved = {}
+        if path is not None:
+            try:
+                with open(path) as f:
+                    saved = json.load(f)['files']
+            except (OSError, ValueError, KeyError):
+                pass
+        for file, entry in saved.items():
+            self._index(file, entry)
+
+        for file in files:
+            self.add(file)
+
+    def __contains__(self, name):
+        return name in self.owners
+
+    def __len__(self):
+        return len(self.files)
+
+    def add(self, file):
+        """Index a file, or index it again if it has changed since. Returns whether it was read."""
+        file = os.path.abspath(file)
+        stat = os.stat(file)
+        entry = self.files.get(file)
+        if entry is not None and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime_ns:
+            return False
+
+        framenames, source_hash, error = read_framenames(file)
+        if entry is not None:
+            self.remove(file)
+        self._index(file, {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'hash': source_hash, 'framenames': framenames, 'error': error})
+        return True
+
+    def remove(self, file):
+        """Drop a file from the index"""
+        file = os.path.abspath(file)
+        for name, count in self.files.pop(file)['framenames'].items():
+            del self.owners[name][file]
+            if len(self.owners[name]) == 0:
+                del self.owners[name]
+            for i in range(count):
+                self.names.remove(name)
+
+    def refresh(self, files=None):
+        """
+        Bring the index up to date: files that have changed are read again, and files that no longer exist are dropped.
+        files, if given, is the full list of files the work should now have, so new files are added and any others dropped. Returns the files read or dropped.
+        """
+        changed = []
+        wanted = None if files is None else set(os.path.abspath(file) for file in files)
+        for file in list(self.files):
+            if not os.path.exists(file) or (wanted is not None and file not in wanted):
+                self.remove(file)
+                changed.append(file)
+        for file in (list(self.files) if wanted is None else sorted(wanted)):
+            if self.add(file):
+                changed.append(file)
+        return changed
+
+    def save(self, path=None):
+        """Save the index as JSON, to path or wherever it was loaded from"""
+        path = self.path if path is None else path
+        directory = os.path.dirname(path)
+        if directory != '':
+            os.makedirs(directory, exist_ok=True)
+        # Write to a temporary file first, so that the index is never half-written
+        with open(path + '.' + str(os.getpid()) + '.tmp', 'w') as f:
+            f.write(json.dumps({'files': self.files}))
+        os.replace(path + '.' + str(os.getpid()) + '.tmp', path)
+
+    def defined_outside(self, name, file):
+        """Whether a topos in any file other than file has this framename"""
+        owners = self.owners.get(name)
+        return owners is not None and (len(owners) > 1 or os.path.abspath(file) not in owners)
+
+    def where(self, name):
+        """The files with a topos with this framename"""
+        return sorted(self.owners.get(name, ()))
+
+    def hash(self, file):
+        """The SHA-256 of a file when it was last indexed, or None if it isn't in the index"""
+        entry = self.files.get(os.path.abspath(file))
+        return None if entry is None else entry['hash']
+
+    def _index(self, file, entry):
+        self.files[file] = entry
+        for name, count in entry['framenames'].items():
+            self.owners.setdefault(name, {})[file] = count
+            self.names.add(name, count)
+
+
+class WorkNames:
+    """
+    The framenames that the references in one file of a work can resolve to: the file's own, and those in the work's other files.
+    The file's own framenames are passed in separately, rather than taken from the index, as the file may have been edited since it was indexed.
+    Can be used wherever a SuggestionIndex of a document's framenames is, eg. by the deferred rules.
+    """
+
+    def __init__(self, local, work, file=None):
+        self.local = local
+        self.work = work
+        self.file = '' if file is None else file
+
+    def __contains__(self, name):
+        return name in self.local or self.work.defined_outside(name, self.file)
+
+    def suggest(self, word, limit=3, cutoff=0.6):
+        elsewhere = [name for name in self.work.names.suggest(word, limit * 2, cutoff) if self.work.defined_outside(name, self.file)]
+        return closest(word, self.local.suggest(word, limit, cutoff) + elsewhere, limit, cutoff)
+
+
+class Rule:
+    """
+    A check on one kind of element. check is called with the element's attributes, and returns the text of a finding, or None if there's nothing to report.
+    A check can also return (text, suggestions), where suggestions are the names that were probably meant, best first - see did_you_mean.
+    Deferred rules are run once the whole document has been read, and are also passed a SuggestionIndex of every topos framename in the document (or a WorkNames, for a file of a multi-file work).
+    """
+
+    name = None
+    tag = None
+    type = None
+    category = None
+    check = None
+    deferred = False
+
+    def __init__(self, name, tag, type, category, check, deferred=False):
+        self.name = name
+        self.tag = tag
+        self.type = type
+        self.category = category
+        self.check = check
+        self.deferred = deferred
+
+
+# Every rule, in the order their findings are reported for elements on the same line
+RULES = []
+
+
+def rule(name, tag, type, category, deferred=False):
+    """Decorator that adds a check function to RULES"""
+    def register(check):
+        RULES.append(Rule(name, tag, type, category, check, deferred))
+        return check
+    return register
+
+
+@rule('topos-type-missing', 'topos', 'error', 'topos')
+def check_topos_type_missing(attrib):
+    if 'type' not in attrib:
+        return '<topos> missing required "type" attribute'
+
+@rule('topos-type-unknown', 'topos', 'warning', 'topos')
+def check_topos_type_unknown(attrib):
+    if 'type' in attrib and attrib['type'] not in chronotope_set:
+        return did_you_mean(f'Unknown chronotope type "{attrib["type"]}". Valid types: {", ".join(chronotopes)}', chronotope_index.suggest(attrib['type']))
+
+@rule('topos-framename-missing', 'topos', 'error', 'topos')
+def check_topos_framename_missing(attrib):
+    if 'framename' not in attrib:
+        return '<topos> missing required "framename" attribute'
+
+@rule('connection-source-missing', 'connection', 'error', 'connection')
+def check_connection_source_missing(attrib):
+    if 'source' not in attrib:
+        return '<connection> missing required "source" attribute'
+
+@rule('connection-target-missing', 'connection', 'error', 'connection')
+def check_connection_target_missing(attrib):
+    if 'target' not in attrib:
+        return '<connection> missing required "target" attribute'
+
+@rule('connection-relation-missing', 'connection', 'error', 'connection')
+def check_connection_relation_missing(attrib):
+    if 'relation' not in attrib:
+        return '<connection> missing required "relation" attribute'
+
+@rule('connection-relation-unknown', 'connection', 'warning', 'connection')
+def check_connection_relation_unknown(attrib):
+    if 'relation' in attrib and attrib['relation'] not in connection_set:
+        return did_you_mean(f'Unknown relation type "{attrib["relation"]}". Valid types: {", ".join(connections)}', connection_index.suggest(attrib['relation']))
+
+@rule('connection-source-reference', 'connection', 'error', 'reference', deferred=True)
+def check_connection_source_reference(attrib, framenames):
+    if 'source' in attrib and attrib['source'] not in framenames:
+        return did_you_mean(f'Connection source "{attrib["source"]}" does not match any topos framename', framenames.suggest(attrib['source']))
+
+@rule('connection-target-reference', 'connection', 'error', 'reference', deferred=True)
+def check_connection_target_reference(attrib, framenames):
+    if 'target' in attrib and attrib['target'] not in framenames:
+        return did_you_mean(f'Connection target "{attrib["target"]}" does not match any topos framename', framenames.suggest(attrib['target']))
+
+@rule('toporef-role-missing', 'toporef', 'error', 'toporef')
+def check_toporef_role_missing(attrib):
+    if 'role' not in attrib:
+        return '<toporef> missing required "role" attribute'
+
+@rule('toporef-relation-missing', 'toporef', 'error', 'toporef')
+def check_toporef_relation_missing(attrib):
+    # The relation is optional for toporefs in a sequence
+    if 'sequence' not in attrib and 'relation' not in attrib:
+        return '<toporef> missing required "relation" attribute'
+
+@rule('toporef-relation-unknown', 'toporef', 'warning', 'toporef')
+def check_toporef_relation_unknown(attrib):
+    if 'relation' in attrib and attrib['relation'] not in connection_set:
+        return did_you_mean(f'Unknown relation type "{attrib["relation"]}". Valid types: {", ".join(connections)}', connection_index.suggest(attrib['relation']))
+
+
+def finding(rule, line, text):
+    """A finding as reported to sinks. type is 'error' or 'warning'. Findings of rules that make suggestions also have a list of suggestions."""
+    suggestions = None
+    if isinstance(text, tuple):
+        text, suggestions = text
+
+    f = {
+        'type': rule.type,
+        'category': rule.category,
+        'line': line,
+        'message': f'Line {line}: {text}',
+        'rule': rule.name
+    }
+    if suggestions is not None:
+        f['suggestions'] = suggestions
+    return f
+
+
+def sort_findings(findings, rules=RULES):
+    """Sort findings by line. Findings on the same line are grouped by category, in the order the categories' rules are registered."""
+    order = {}
+    for r in rules:
+        order.setdefault(r.category, len(order))
+    findings.sort(key=lambda f: (f.get('line', 0), order.get(f['category'], len(order))))
+    return findings
+
+
+def problems(tag, attrib, rules=RULES, framenames=None):
+    """
+    Runs the rules for one element outside an engine, eg. for a validator that keeps its own framenames. Returns (rule, text) for each finding.
+    Without framenames the deferred rules are skipped, and with them only the deferred rules are run.
+    """
+    found = []
+    for r in rules:
+        if r.tag != tag or r.deferred != (framenames is not None):
+            continue
+        text = r.check(attrib) if framenames is None else r.check(attrib, framenames)
+        if text is not None:
+            found.append((r, text))
+    return found
+
+
+class RuleEngine:
+    """
+    Runs a set of rules over the elements of a document in a single pass, reporting each finding to every sink as it's found.
+    Elements can be passed in one at a time with check, eg. by a streaming parser, or a whole tree checked with validate. Deferred rules run in finish.
+    Counts and timings are kept for every rule, so the most costly checks on a large document can be found.
+    With max_errors set, the engine stops once that many errors have been found: later elements are ignored, and the deferred rules aren't run, as the framenames they need are incomplete.
+    With work set to a FramenameIndex, references can also resolve to the topoi of the work's other files. file is the path of the document being checked, if it's one of them.
+    """
+
+    rules = None
+    sinks = None
+
+    # Rule name -> {'calls', 'findings', 'seconds'}
+    stats = None
+
+    # Every topos framename seen so far, as a SuggestionIndex
+    framenames = None
+
+    max_errors = None
+    error_count = 0
+
+    # The FramenameIndex of the work the document belongs to, and the document's path, if any
+    work = None
+    file = None
+
+    # Whether the engine has stopped, eg. because it's found max_errors errors. Set it to stop the engine for other reasons, eg. a syntax error.
+    stopped = False
+
+    def __init__(self, rules=None, sinks=(), max_errors=None, work=None, file=None):
+        self.rules = RULES if rules is None else rules
+        self.sinks = list(sinks)
+        self.max_errors = max_errors
+        self.work = work
+        self.file = file
+        self.stats = {r.name: {'calls': 0, 'findings': 0, 'seconds': 0.0} for r in self.rules}
+        self.framenames = SuggestionIndex()
+
+        # Rules by tag, so that each element only goes through the rules for its own tag
+        self._local = {tag: [r for r in self.rules if r.tag == tag and not r.deferred] for tag in TAGS}
+        self._deferred = {tag: [r for r in self.rules if r.tag == tag and r.deferred] for tag in TAGS}
+
+        # (rule list, line, attributes) of the elements waiting for deferred rules
+        self._waiting = []
+
+    def check(self, tag, attrib, line):
+        """Run the rules for one element"""
+        if tag not in self._local or self.stopped:
+            return
+
+        if tag == 'topos' and 'framename' in attrib:
+            self.framenames.add(attrib['framename'])
+
+        for r in self._local[tag]:
+            self._run(r, line, attrib)
+            if self.stopped:
+                return
+
+        if len(self._deferred[tag]) > 0:
+            self._waiting.append((self._deferred[tag], line, dict(attrib)))
+
+    def finish(self):
+        """Run the deferred rules, and close the sinks. Returns the stats."""
+        framenames = self.framenames if self.work is None else WorkNames(self.framenames, self.work, self.file)
+        for rules, line, attrib in self._waiting:
+            for r in rules:
+                if self.stopped:
+                    break
+                self._run(r, line, attrib, framenames)
+        self._waiting = []
+
+        for sink in self.sinks:
+            sink.close(self.stats)
+        return self.stats
+
+    def validate(self, root):
+        """Check every element in a tree, then finish"""
+        for el in root.iter(*TAGS):
+            self.check(el.tag, el.attrib, el.sourceline)
+            if self.stopped:
+                break
+        return self.finish()
+
+    def partial(self):
+        """
+        What this engine has found so far, other than the findings themselves, for another engine to merge. Used to check the parts of a document in separate processes.
+        The engine shouldn't have been finished, so that the deferred rules can be run once every part's framenames are known.
+        """
+        return {
+            'framenames': self.framenames.counts,
+            'waiting': [(rules[0].tag, line, attrib) for rules, line, attrib in self._waiting],
+            'stats': self.stats
+        }
+
+    def merge(self, partial, findings=()):
+        """Merge in the partial results and findings of an engine that checked part of the document, reporting the findings to this engine's sinks"""
+        self.framenames.update(partial['framenames'])
+        for tag, line, attrib in partial['waiting']:
+            self._waiting.append((self._deferred[tag], line, attrib))
+        for name, stats in partial['stats'].items():
+            for key in stats:
+                self.stats[name][key] += stats[key]
+
+        for f in findings:
+            if self.stopped:
+                break
+            for sink in self.sinks:
+                sink.write(f)
+            if f['type'] == 'error':
+                self.error_count += 1
+                if self.max_errors is not None and self.error_count >= self.max_errors:
+                    self.stopped = True
+
+    def _run(self, r, line, attrib, *args):
+        started = time.perf_counter()
+        text = r.check(attrib, *args)
+        stats = self.stats[r.name]
+        stats['seconds'] += time.perf_counter() - started
+        stats['calls'] += 1
+        if text is not None:
+            stats['findings'] += 1
+            f = finding(r, line, text)
+            for sink in self.sinks:
+                sink.write(f)
+            if r.type == 'error':
+                self.error_count += 1
+                if self.max_errors is not None and self.error_count >= self.max_errors:
+                    self.stopped = True
+
+
+class ListSink:
+    """Keeps the findings in a list, sorted as validate_xml returns them once the engine has finished"""
+
+    def __init__(self):
+        self.findings = []
+        self.stats = None
+
+    def write(self, finding):
+        self.findings.append(finding)
+
+    def close(self, stats):
+        sort_findings(self.findings)
+        self.stats = stats
+
+
+class TextSink:
+    """Prints each finding as a line of text, and a table of the rules' counts and timings at the end"""
+
+    def __init__(self, stream=None, show_stats=True):
+        self.stream = sys.stdout if stream is None else stream
+        self.show_stats = show_stats
+        self.count = 0
+
+    def write(self, finding):
+        self.count += 1
+        self.stream.write(finding['type'].capitalize() + ': ' + finding['message'] + '\n')
+
+    def close(self, stats):
+        if self.count == 0:
+            self.stream.write('No errors or warnings found!\n')
+        if self.show_stats:
+            self.stream.write(stats_table(stats))
+
+
+class JSONSink:
+    """Writes the findings, sorted, and the rules' stats as a single JSON document at the end"""
+
+    def __init__(self, stream=None):
+        self.stream = sys.stdout if stream is None else stream
+        self.findings = []
+
+    def write(self, finding):
+        self.findings.append(finding)
+
+    def close(self, stats):
+        json.dump({'findings': sort_findings(self.findings), 'stats': stats}, self.stream, indent=4)
+        self.stream.write('\n')
+
+
+class NDJSONSink:
+    """Writes each finding as a line of JSON as soon as it's found. With stats set, a final line holds the rules' stats."""
+
+    def __init__(self, stream=None, stats=False, **fields):
+        """Any extra fields, eg. file, are added to every record"""
+        self.stream = sys.stdout if stream is None else stream
+        self.show_stats = stats
+        self.fields = fields
+
+    def write(self, finding):
+        self.stream.write(json.dumps(dict(self.fields, **finding)) + '\n')
+
+    def close(self, stats):
+        if self.show_stats:
+            self.stream.write(json.dumps(dict(self.fields, stats=stats)) + '\n')
+
+
+class PprintSink:
+    """
+    Prints the report the notebooks' CCXMLValidator.check_xml has always printed, once the engine has finished: the errors, the attribute typos (warnings) and the source and target mismatches, each pretty-printed as lists of messages by kind of element.
+    """
+
+    # The report's key for each category of finding, and for each reference rule
+    sections = {'topos': 'nodes', 'connection': 'connections', 'toporef': 'toporefs'}
+    references = {'connection-source-reference': 'sources', 'connection-target-reference': 'targets'}
+
+    def __init__(self, stream=None):
+        self.stream = sys.stdout if stream is None else stream
+        self.errors = {'nodes': [], 'connections': [], 'toporefs': []}
+        self.warnings = {'nodes': [], 'connections': [], 'toporefs': []}
+        self.mismatches = {'sources': [], 'targets': []}
+
+    def write(self, finding):
+        if finding['rule'] in self.references:
+            self.mismatches[self.references[finding['rule']]].append(finding['message'])
+        elif finding['type'] == 'error':
+            self.errors[self.sections[finding['category']]].append(finding['message'])
+        else:
+            self.warnings[self.sections[finding['category']]].append(finding['message'])
+
+    def close(self, stats):
+        message = 'Errors:\n'
+        if any(len(found) > 0 for found in self.errors.values()):
+            message += pprint.pformat(self.errors)
+        else:
+            message += 'No errors found!\n'
+
+        message += 'Attribute typos:\n'
+        if any(len(found) > 0 for found in self.warnings.values()):
+            message += pprint.pformat(self.warnings)
+        else:
+            message += 'No attribute typos found!\n'
+
+        message += 'Source and Target mis-matches:\n'
+        if any(len(found) > 0 for found in self.mismatches.values()):
+            message += pprint.pformat(self.mismatches)
+        else:
+            message += 'No mismatches found!\n'
+
+        self.stream.write(message + '\n')
+
+
+def stats_table(stats):
+    """A text table of rule stats, the most costly rule first"""
+    table = '{:<30} {:>10} {:>10} {:>10}\n'.format('Rule', 'Calls', 'Findings', 'ms')
+    for name, s in sorted(stats.items(), key=lambda item: -item[1]['seconds']):
+        table += '{:<30} {:>10} {:>10} {:>10.2f}\n'.format(name, s['calls'], s['findings'], s['seconds'] * 1000)
+    return table